@@ -0,0 +1,350 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the podcast scripts.
+
+ benchmark.py catalog [course-list-file]
+
+Compares reading the list of all courses with json.load against
+reading it with coursera_rss.iter_courses, which streams the list
+and only keeps the fields we use.  Uses the bundled
+course-list.20130318 if no file is given.
+
+ benchmark.py templates
+
+Times the first render of each of the app's templates in a new
+process, loading them from their files (what a new instance used to
+do), from a warm bytecode cache, and from modules compiled by
+templates.py.
+
+ benchmark.py parse [lecture-index-file]
+
+Compares parsing a lecture index page into a full soup against
+coursera_rss.parse_lecture_index, which only builds the week headers
+and lecture lists into the soup.  Uses a page from coursera_stub
+(about 110 KB, like Coursera's) if no file is given.  html.parser
+still tokenizes the whole page either way, so the time is about the
+same; what's saved is the memory of the tree.
+
+ benchmark.py startup
+
+Times the imports a new App Engine instance does before it can serve
+a request.  The app case is what serving a feed or the home page
+costs now; app+scraper adds coursera_rss and BeautifulSoup, which the
+app used to import up front and now only imports to update a course.
+Needs the App Engine SDK on the python path for the app cases.
+
+Each case is run in a fresh python process, so that its time and
+peak memory don't depend on what ran before it.  The memory is how
+much the peak resident size grew while running the case.
+"""
+
+import json
+from   optparse   import OptionParser
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+COURSE_LIST = os.path.join(HERE, 'course-list.20130318')
+
+# --------------------------------------------------------------------
+# Main and command line arguments
+
+def main():
+    opts, args = getopts()
+    if opts.child is not None:
+        run_child(opts.child, args)
+        return
+    if len(args) == 0 or args[0] not in BENCHMARKS:
+        print "Usage: benchmark.py [%s] ..." % '|'.join(sorted(BENCHMARKS))
+        sys.exit(1)
+    BENCHMARKS[args[0]](opts, args[1:])
+
+def getopts():
+    """
+    parse command line
+    """
+    parser = OptionParser()
+    parser.add_option('--repeat',
+                      type='int',
+                      default=3,
+                      help='how many times to run each case')
+    parser.add_option('--child',
+                      help='run a single case in this process')
+    return parser.parse_args()
+
+# --------------------------------------------------------------------
+# Running cases
+
+def measure(case, args, repeat):
+    """
+    Run a case in a fresh process repeat times.  Returns the best
+    time, and the largest growth in peak memory, in KB.
+    """
+    times = []
+    memory = []
+    for _ in range(repeat):
+        out = subprocess.check_output(
+            [sys.executable, os.path.abspath(__file__), '--child', case]
+            + list(args), cwd=HERE)
+        result = json.loads(out.splitlines()[-1])
+        times.append(result['seconds'])
+        memory.append(result['kb'])
+    return (min(times), max(memory))
+
+def can_import(module):
+    """
+    Whether module can be imported, without importing it here.
+    """
+    return subprocess.call([sys.executable, '-c', 'import ' + module],
+                           cwd=HERE, stderr=open(os.devnull, 'w')) == 0
+
+def run_child(case, args):
+    """
+    Run a single case and print its time and memory as JSON.
+    """
+    setup = CASES[case]
+    func = setup(*args)
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    result = func()
+    seconds = time.time() - start
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    del result
+    print json.dumps({'seconds': seconds, 'kb': after - before})
+
+def report(title, rows):
+    """
+    Print (case, seconds, kb) rows, comparing each to the first.
+    """
+    print title
+    (_, base_time, base_kb) = rows[0]
+    for (case, seconds, kb) in rows:
+        print "  %-24s %8.1f ms %10d KB   %5.2fx time %5.2fx memory" % (
+            case, seconds * 1000, kb,
+            seconds / base_time if base_time else 0,
+            float(kb) / base_kb if base_kb else 0)
+
+# --------------------------------------------------------------------
+# Cases.  Each takes the arguments given on the command line, does
+# any setup, and returns the function to time.
+
+def load_json(path=COURSE_LIST):
+    def run():
+        with open(path) as fd:
+            return json.load(fd)
+    return run
+
+def load_streaming(path=COURSE_LIST):
+    import coursera_rss
+    def run():
+        with open(path) as fd:
+            return list(coursera_rss.iter_courses(fd))
+    return run
+
+def parse_full(path):
+    import coursera_rss
+    with open(path) as fd:
+        html = fd.read()
+    def run():
+        return coursera_rss.READURL.parse(html)
+    return run
+
+def parse_strained(path):
+    import coursera_rss
+    with open(path) as fd:
+        html = fd.read()
+    def run():
+        return coursera_rss.parse_lecture_index(html)
+    return run
+
+def import_app():
+    import imp
+    def run():
+        return imp.load_source('podcast',
+                               os.path.join(HERE, 'gae-coursera-podcast.py'))
+    return run
+
+def import_app_and_scraper():
+    load_app = import_app()
+    def run():
+        app = load_app()
+        import coursera_rss
+        from bs4 import BeautifulSoup
+        return app
+    return run
+
+def import_coursera_rss():
+    def run():
+        import coursera_rss
+        return coursera_rss
+    return run
+
+def import_bs4():
+    def run():
+        from bs4 import BeautifulSoup
+        return BeautifulSoup
+    return run
+
+class FakeKey(object):
+    def __init__(self, name):
+        self.key_name = name
+    def name(self):
+        return self.key_name
+
+class FakeEntity(object):
+    """
+    Enough of a Course or Lecture to render the templates with.
+    """
+    def __init__(self, key_name, **fields):
+        self.__dict__.update(fields)
+        self.key_name = key_name
+    def key(self):
+        return FakeKey(self.key_name)
+    def preview_text(self):
+        return "Preview"
+    def pubDate(self):
+        return "Mon, 18 Mar 2013 00:00:00 -0500"
+    lastBuildDate = pubDate
+
+def template_contexts(lectures=100):
+    course = FakeEntity('ml', full_name='Machine Learning',
+                        instructor='Andrew Ng', url='https://class/ml/',
+                        description='Learn about machine learning. ' * 5,
+                        icon_url='https://s3/ml.png', preview_url='p',
+                        last_updated='2013-03-18')
+    lecture_list = [FakeEntity(str(ii), name='Lecture %d' % ii,
+                               description='Week 1 : Lecture %d' % ii,
+                               url='https://s3/ml/%d.mp4' % ii,
+                               size='12345678', duration='10:00')
+                    for ii in range(lectures)]
+    return [('home.html', {'courses': [course] * 50, 'prefix': '',
+                           'next_page': '/home?cursor=x'}),
+            ('course.xml', {'course': course, 'lectures': lecture_list}),
+            ('notfound.html', {'name': 'ml'}),
+            ('nopreview.html', {'name': 'ml'}),
+            ('refresh.html', {'runs': []})]
+
+def first_renders(env):
+    def run():
+        return [env.get_template(name).render(context)
+                for (name, context) in template_contexts()]
+    return run
+
+def render_from_files():
+    import templates
+    return first_renders(templates.make_environment(
+        development=False, compiled_dir=None, memcache_client=None))
+
+def render_from_bytecode(cache_dir):
+    import jinja2
+    import templates
+    return first_renders(templates.make_environment(
+        development=False, compiled_dir=None,
+        bytecode_cache=jinja2.FileSystemBytecodeCache(cache_dir)))
+
+def render_compiled(compiled_dir):
+    import templates
+    return first_renders(templates.make_environment(
+        development=False, compiled_dir=compiled_dir, memcache_client=None))
+
+CASES = {
+    'files': render_from_files,
+    'bytecode cache': render_from_bytecode,
+    'compiled': render_compiled,
+    'json.load': load_json,
+    'iter_courses': load_streaming,
+    'full soup': parse_full,
+    'strained soup': parse_strained,
+    'app': import_app,
+    'app+scraper': import_app_and_scraper,
+    'coursera_rss': import_coursera_rss,
+    'bs4': import_bs4,
+    }
+
+# --------------------------------------------------------------------
+# Benchmarks
+
+def bench_catalog(opts, args):
+    path = args[0] if len(args) > 0 else COURSE_LIST
+    rows = []
+    for case in ('json.load', 'iter_courses'):
+        (seconds, kb) = measure(case, [path], opts.repeat)
+        rows.append((case, seconds, kb))
+    report("Reading %s (%d bytes)" % (path, os.path.getsize(path)), rows)
+
+def bench_parse(opts, args):
+    if len(args) > 0:
+        bench_parse_page(opts, args[0])
+        return
+    import coursera_stub
+    (stub_opts, _) = coursera_stub.getopts([])
+    (fd, path) = tempfile.mkstemp(suffix='.html')
+    try:
+        with os.fdopen(fd, 'w') as out:
+            out.write(coursera_stub.lecture_index_page(
+                'http://localhost:8080', 'stub001', stub_opts))
+        bench_parse_page(opts, path)
+    finally:
+        os.remove(path)
+
+def bench_parse_page(opts, path):
+    rows = []
+    for case in ('full soup', 'strained soup'):
+        (seconds, kb) = measure(case, [path], opts.repeat)
+        rows.append((case, seconds, kb))
+    report("Parsing lecture index %s (%d bytes)" % (path,
+                                                     os.path.getsize(path)),
+           rows)
+
+def bench_startup(opts, args):
+    cases = ['coursera_rss', 'bs4']
+    if can_import('google.appengine.ext.db') and can_import('webapp2'):
+        cases = ['app', 'app+scraper'] + cases
+    else:
+        print "No App Engine SDK, so just timing the scraper imports"
+    rows = []
+    for case in cases:
+        (seconds, kb) = measure(case, [], opts.repeat)
+        rows.append((case, seconds, kb))
+    report("Cold imports", rows)
+
+def bench_templates(opts, args):
+    import jinja2
+    import templates
+    work = tempfile.mkdtemp()
+    try:
+        compiled_dir = os.path.join(work, 'compiled')
+        cache_dir = os.path.join(work, 'bytecode')
+        os.mkdir(cache_dir)
+        templates.compile_all(compiled_dir, verbose=False)
+        # Warm the bytecode cache, the way the first instance would
+        first_renders(templates.make_environment(
+            development=False, compiled_dir=None,
+            bytecode_cache=jinja2.FileSystemBytecodeCache(cache_dir)))()
+        rows = []
+        for (case, case_args) in (('files', []),
+                                  ('bytecode cache', [cache_dir]),
+                                  ('compiled', [compiled_dir])):
+            (seconds, kb) = measure(case, case_args, opts.repeat)
+            rows.append((case, seconds, kb))
+        report("First render of every template", rows)
+    finally:
+        shutil.rmtree(work)
+
+BENCHMARKS = {
+    'catalog': bench_catalog,
+    'templates': bench_templates,
+    'parse': bench_parse,
+    'startup': bench_startup,
+    }
+
+# --------------------------------------------------------------------
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+"""
+Recording HTTP responses, and playing them back later.
+
+A Cassette is a directory holding every response read through it:
+
+ index.json   request -> the responses to it, in the order they came
+ bodies/      one file per response body
+
+In record mode, requests go out as usual and each response is saved.
+In replay mode, nothing goes out: each request gets the response that
+was recorded for it, and a request that wasn't recorded fails with
+CassetteMiss (a urllib2.URLError, like a network error).  Asking for
+the same url several times plays back its responses in the order
+they were recorded, and then the last one again.  Replay can wait
+latency seconds before each response, to act like the network.
+
+Requests are matched by method, url and a hash of the data sent, not
+by headers, so cookies and csrf tokens that change from run to run
+don't matter.  The recorded responses do include any cookies Coursera
+set, so don't share a cassette recorded with a login.
+
+coursera_rss.ReadUrl plays and records through CASSETTE, and
+coursera_dl's openers through a CassetteHandler, so both can be run
+offline with --cassette DIR --cassette_mode replay.
+"""
+
+import hashlib
+import httplib
+import json
+import os
+import threading
+import time
+import urllib
+import urllib2
+from   cStringIO import StringIO
+
+MODES = ('record', 'replay')
+
+class CassetteMiss(urllib2.URLError):
+    """
+    Raised when replaying a request that wasn't recorded.
+    """
+    pass
+
+class Cassette(object):
+    """
+    An archive of recorded responses, in directory path.  Recording
+    starts a new archive, replacing anything already there.
+    """
+    def __init__(self, path, mode='replay', latency=0.0):
+        if mode not in MODES:
+            raise ValueError("Cassette mode must be one of %s" % (MODES,))
+        self.path    = path
+        self.mode    = mode
+        self.latency = latency
+        self.lock    = threading.Lock()
+        # key -> how many times it has been played back
+        self.played  = {}
+        self.index   = {}
+        if mode == 'record':
+            if not os.path.isdir(os.path.join(path, 'bodies')):
+                os.makedirs(os.path.join(path, 'bodies'))
+            self.save_index()
+        else:
+            with open(os.path.join(path, 'index.json')) as fd:
+                self.index = json.load(fd)
+
+    @property
+    def replaying(self):
+        return self.mode == 'replay'
+
+    @property
+    def recording(self):
+        return self.mode == 'record'
+
+    def play(self, req):
+        """
+        Returns the recorded (status, reason, headers, body) for the
+        urllib2.Request, where headers is an httplib.HTTPMessage.
+        """
+        key = request_key(req)
+        with self.lock:
+            responses = self.index.get(key)
+            if not responses:
+                raise CassetteMiss("Not recorded: %s" % key)
+            count = self.played.get(key, 0)
+            self.played[key] = count + 1
+            response = responses[min(count, len(responses) - 1)]
+        with open(os.path.join(self.path, 'bodies', response['body']),
+                  'rb') as fd:
+            body = fd.read()
+        if self.latency > 0:
+            time.sleep(self.latency)
+        headers = httplib.HTTPMessage(StringIO(response['headers']))
+        return (response['status'], response['reason'], headers, body)
+
+    def record(self, req, status, reason, headers, body):
+        """
+        Save a response to the urllib2.Request.  headers is the
+        httplib.HTTPMessage it came with.
+        """
+        key = request_key(req)
+        with self.lock:
+            responses = self.index.setdefault(key, [])
+            name = '%s-%d' % (hashlib.sha1(key).hexdigest(), len(responses))
+            with open(os.path.join(self.path, 'bodies', name), 'wb') as fd:
+                fd.write(body)
+            responses.append({'url': req.get_full_url(),
+                              'status': status,
+                              'reason': reason,
+                              'headers': ''.join(headers.headers),
+                              'body': name})
+            self.save_index()
+
+    def response(self, req):
+        """
+        Play back the response to req as a urllib response object.
+        """
+        (status, reason, headers, body) = self.play(req)
+        return make_response(req, status, reason, headers, body)
+
+    def save_index(self):
+        path = os.path.join(self.path, 'index.json')
+        tmp = '%s.tmp%d' % (path, os.getpid())
+        with open(tmp, 'w') as fd:
+            json.dump(self.index, fd, indent=1, sort_keys=True)
+        os.rename(tmp, path)
+
+def request_key(req):
+    """
+    What a recorded response is looked up by: the method, url and a
+    hash of any data of the urllib2.Request.
+    """
+    key = '%s %s' % (req.get_method(), req.get_full_url())
+    if req.has_data():
+        key += ' ' + hashlib.sha1(req.get_data()).hexdigest()
+    return key
+
+def make_response(req, status, reason, headers, body):
+    """
+    A urllib response object, like urllib2 returns, for a response
+    that has already been read.
+    """
+    res = urllib.addinfourl(StringIO(body), headers, req.get_full_url(),
+                            status)
+    res.msg = reason
+    return res
+
+class CassetteHandler(urllib2.BaseHandler):
+    """
+    A urllib2 handler which plays back responses from a Cassette, or
+    records the responses that the other handlers get.  It goes before
+    the other handlers, so when replaying, nothing goes out.
+    """
+    handler_order = 100
+
+    def __init__(self, cassette):
+        self.cassette = cassette
+
+    def http_open(self, req):
+        if self.cassette.replaying:
+            return self.cassette.response(req)
+        return None
+
+    https_open = http_open
+
+    def http_response(self, req, res):
+        if not self.cassette.recording:
+            return res
+        body = res.read()
+        res.close()
+        self.cassette.record(req, res.code, res.msg, res.info(), body)
+        return make_response(req, res.code, res.msg, res.info(), body)
+
+    https_response = http_response
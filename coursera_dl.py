@@ -46,8 +46,16 @@ try:
 except ImportError:
     from bs4 import BeautifulSoup
 
+import cassette
+
 csrftoken = ''
 session = ''
+# Where the classes are, and where to log in
+class_site = 'https://class.coursera.org'
+www_site = 'https://www.coursera.org'
+# If set, a cassette.Cassette that all requests are recorded to or
+# played back from.
+http_cassette = None
 
 
 class ClassNotFoundException(BaseException):
@@ -106,12 +114,12 @@ def get_auth_url(className):
     Return the URL for authentication of the class given by className.
     """
 
-    return 'https://class.coursera.org/%s/auth/auth_redirector?type=login&subtype=normal&email=&visiting=&minimal=true' \
-        % className
+    return '%s/%s/auth/auth_redirector?type=login&subtype=normal&email=&visiting=&minimal=true' \
+        % (class_site, className)
 
 
 def get_new_auth_url():
-    return 'https://www.coursera.org/maestro/api/user/login'
+    return '%s/maestro/api/user/login' % www_site
 
 
 def get_syllabus_url(className):
@@ -119,7 +127,7 @@ def get_syllabus_url(className):
     Return the Coursera index/syllabus URL.
     """
 
-    return 'https://class.coursera.org/%s/lecture/index' % className
+    return '%s/%s/lecture/index' % (class_site, className)
 
 
 def write_cookie_file(className, username, password):
@@ -136,7 +144,7 @@ def write_cookie_file(className, username, password):
             urllib2.HTTPSHandler(),
             urllib2.HTTPCookieProcessor(cookies)
         ]
-        opener = urllib2.build_opener(*handlers)
+        opener = build_opener(*handlers)
 
         req = urllib2.Request(get_syllabus_url(className))
         print opener
@@ -154,9 +162,9 @@ def write_cookie_file(className, username, password):
 
         # Now make a call to the authenticator url:
         cj = cookielib.MozillaCookieJar(fn)
-        opener = urllib2.build_opener(urllib2.HTTPCookieProcessor(cj),
-                                      urllib2.HTTPHandler(),
-                                      urllib2.HTTPSHandler())
+        opener = build_opener(urllib2.HTTPCookieProcessor(cj),
+                              urllib2.HTTPHandler(),
+                              urllib2.HTTPSHandler())
 
         opener.addheaders.append(('Cookie', 'csrftoken=%s' % csrftoken))
         opener.addheaders.append(('Referer', 'https://www.coursera.org'))
@@ -191,14 +199,14 @@ def down_the_wabbit_hole(className, cookies_file):
     """
     Get the session cookie
     """
-    auth_redirector_url = str('https://class.coursera.org/%s/auth/auth_redirector?type=login&subtype=normal&email=&visiting=%s' % (className, urllib.quote_plus(get_syllabus_url(className))))
+    auth_redirector_url = str('%s/%s/auth/auth_redirector?type=login&subtype=normal&email=&visiting=%s' % (class_site, className, urllib.quote_plus(get_syllabus_url(className))))
 
     global session
     cj = get_cookie_jar(cookies_file)
 
-    opener = urllib2.build_opener(urllib2.HTTPCookieProcessor(cj),
-                                  urllib2.HTTPHandler(),
-                                  urllib2.HTTPSHandler())
+    opener = build_opener(urllib2.HTTPCookieProcessor(cj),
+                          urllib2.HTTPHandler(),
+                          urllib2.HTTPSHandler())
 
     req = urllib2.Request(auth_redirector_url)
     opener.open(req)
@@ -211,6 +219,17 @@ def down_the_wabbit_hole(className, cookies_file):
     opener.close()
 
 
+def build_opener(*handlers):
+    """
+    Like urllib2.build_opener, but the opener goes through
+    http_cassette, if there is one.
+    """
+
+    if http_cassette is not None:
+        handlers += (cassette.CassetteHandler(http_cassette),)
+    return urllib2.build_opener(*handlers)
+
+
 def get_netrc_path(path=None):
     """
     Loads netrc file from given path or default location
@@ -264,9 +283,9 @@ def get_opener(cookies_file):
 
     cj = get_cookie_jar(cookies_file)
 
-    return urllib2.build_opener(urllib2.HTTPCookieProcessor(cj),
-                                urllib2.HTTPHandler(),
-                                urllib2.HTTPSHandler())
+    return build_opener(urllib2.HTTPCookieProcessor(cj),
+                        urllib2.HTTPHandler(),
+                        urllib2.HTTPSHandler())
 
 
 def get_page(url, cookies_file):
@@ -274,7 +293,7 @@ def get_page(url, cookies_file):
     Download an HTML page using the cookiejar.
     """
 
-    opener = urllib2.build_opener(urllib2.HTTPHandler(), urllib2.HTTPSHandler())
+    opener = build_opener(urllib2.HTTPHandler(), urllib2.HTTPSHandler())
     req = urllib2.Request(url)
 
     opener.addheaders.append(('Cookie', 'csrf_token=%s;session=%s' % (csrftoken, session)))
@@ -677,6 +696,31 @@ def parseArgs():
                         '--process_local_page',
                         dest='local_page',
                         help='uses or creates local cached version of syllabus page')
+    parser.add_option('--site',
+                        dest='site',
+                        action='store',
+                        default=None,
+                        help='use this site instead of coursera.org, such as'
+                             ' a coursera_stub.py server')
+    parser.add_option('--cassette',
+                        dest='cassette',
+                        action='store',
+                        default=None,
+                        help='directory to record all responses in, or to'
+                             ' play them back from (see cassette.py)')
+    parser.add_option('--cassette-mode',
+                        dest='cassette_mode',
+                        action='store',
+                        choices=cassette.MODES,
+                        default='replay',
+                        help='record or replay (default: replay)')
+    parser.add_option('--latency',
+                        dest='latency',
+                        action='store',
+                        type='float',
+                        default=0.0,
+                        help='seconds to wait before each response that is'
+                             ' played back (default: 0)')
     parser.add_option('--skip-download',
                         dest='skip_download',
                         action='store_true',
@@ -795,7 +839,16 @@ def main():
     Main entry point for execution as a program (instead of as a module).
     """
 
+    global http_cassette
+    global class_site
+    global www_site
+
     args = parseArgs()
+    if args.site:
+        class_site = www_site = args.site.rstrip('/')
+    if args.cassette:
+        http_cassette = cassette.Cassette(args.cassette, args.cassette_mode,
+                                          args.latency)
     for class_name in args.class_names:
         try:
             logging.info('Downloading class: %s', class_name)
@@ -32,6 +32,12 @@ If run with the --xml option and a course name, it will output an RSS
 XML for a podcast that includes all the lectures (so far) for that
 course.
 
+ cousera.py --cassette DIR --cassette_mode record [course-short-name]
+
+Any of these can also record everything it reads from Coursera in
+DIR, and then run again offline, reading it all from there, with
+--cassette DIR (see cassette.py).
+
 Really, this should use the requests python library to parse web
 pages.  http://docs.python-requests.org/en/latest/.  However, that
 library is not yet compatible with Google App Engine according to
@@ -53,25 +59,81 @@ https://github.com/jplehmann/coursera/commit/6e2725edf9e5c5be88ed5a95c84f6834ada
 
 # We would ideally use requests and mechanize, but I want this to be
 # usable on Google App Engine, so I'm sticking to the older tech.
-from   bs4        import BeautifulSoup
+# BeautifulSoup (bs4) is only imported when we first parse a page (see
+# ReadUrl.bsoup), since just reading the course list doesn't need it.
+import cassette
+from   contextlib import contextmanager
 import cookielib
+from   cStringIO  import StringIO
 from   datetime   import datetime, timedelta
+from   HTMLParser import HTMLParser
+import httplib
 from   itertools  import izip_longest
 import json
-from   logging    import getLogger, DEBUG, debug
+from   logging    import getLogger, DEBUG, debug, warning
 from   optparse   import OptionParser
+import os
+import Queue
 import re
+import socket
+import threading
+import time
 import urllib
 import urllib2
+import urlparse
 
 # --------------------------------------------------------------------
 # Constants
 
-ALL_URL = 'https://www.coursera.org/maestro/api/topic/list?full=1'
+SITE = 'https://www.coursera.org'
+ALL_PATH = '/maestro/api/topic/list?full=1'
+ALL_URL = SITE + ALL_PATH
 LOGIN_PATH = '/auth/auth_redirector?type=login&subtype=normal&email=&visiting=&minimal=true'
 LECTURES_PATH = "/lecture/index"
 TIME_FORMAT = "%a, %d %b %Y %H:%M:%S -0500"
-AUTH_URL = 'https://www.coursera.org/maestro/api/user/login'
+AUTH_PATH = '/maestro/api/user/login'
+AUTH_URL = SITE + AUTH_PATH
+# How many lectures to resolve (video page + HEAD request) at once
+LECTURE_CONCURRENCY = 8
+# Idle connections kept open to each host, and for how many seconds
+POOL_SIZE = 8
+POOL_IDLE_SECONDS = 60
+HTTP_TIMEOUT = 60
+MAX_REDIRECTS = 10
+# How many seconds the list of all courses is used before checking
+# with Coursera whether it has changed
+CATALOG_TTL = 60 * 60
+# How many seconds the size of a video is remembered for (see
+# SizeCache), and that a video which couldn't be found is.
+SIZE_TTL = 30 * 24 * 60 * 60
+SIZE_MISS_TTL = 24 * 60 * 60
+# The fields of each course, and of each instance of a course, that we
+# keep from the list of all courses.  The rest (universities, photos,
+# grading policies, ...) is dropped as soon as it's read.
+COURSE_FIELDS = ('id', 'short_name', 'name', 'instructor',
+                 'short_description', 'large_icon', 'preview_link',
+                 'university-ids', 'category-ids')
+INSTANCE_FIELDS = ('id', 'home_link', 'active',
+                   'start_day', 'start_month', 'start_year')
+USER_AGENT = 'Python-urllib/%s' % urllib2.__version__
+# The classes of the week headers on a lecture index page, and of the
+# lists of lectures that follow them.  The rest of the page (scripts,
+# navigation, ...) isn't parsed.
+LECTURE_INDEX_CLASSES = ('course-item-list-header',
+                         'course-item-list-section-list')
+# How many bytes at a time to read a page that we only need the start
+# of (see ReadUrl.readurl's until).  Stopping early loses the pooled
+# connection, which costs a new handshake, so it's only done when at
+# least SCAN_SKIP bytes would be left unread (or, when we can't tell,
+# once that much has been read).
+SCAN_CHUNK = 4096
+SCAN_SKIP = 64 * 1024
+# <source> tags, and the attributes in them, for finding a lecture's
+# video without parsing its page (see video_source).
+SOURCE_TAG_RE = re.compile(r'<source\b([^>]*)>', re.IGNORECASE)
+ATTRIBUTE_RE = re.compile(
+    r'''([\w:-]+)\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'>]+))''')
+COMMENT_RE = re.compile(r'<!--.*?-->', re.DOTALL)
 #USER_COURSES_URL = 'https://www.coursera.org/maestro/api/topic/list_my?user_id=%s'
 #MY_ID = 101589
 
@@ -87,15 +149,31 @@ AUTH_URL = 'https://www.coursera.org/maestro/api/user/login'
 def main():
     opts, course_names = getopts()
 
+    if opts.site is not None:
+        use_site(opts.site)
+    global CASSETTE
+    if opts.cassette is not None:
+        CASSETTE = cassette.Cassette(opts.cassette, opts.cassette_mode,
+                                     opts.latency)
+
+    courses = opts.courses
+    if opts.courses_cache is not None:
+        courses = CatalogCache(opts.courses_cache, url=ALL_URL,
+                               ttl=opts.courses_ttl)
+    global SIZE_CACHE
+    if opts.size_cache is not None:
+        SIZE_CACHE = SizeCache(FileSizeStore(opts.size_cache),
+                               ttl=opts.size_ttl)
+
     # If we weren't given a course, just print all the courses.
     if len(course_names) == 0:
-        print_course_list(courses_file=opts.courses)
+        print_course_list(courses_file=courses)
         return
 
     for course_name in course_names:
         #print "Running for course {course}".format(course=course_name)
         # Find the given course
-        matches = find_course(course_name, courses_file=opts.courses)
+        matches = find_course(course_name, courses_file=courses)
         if len(matches) < 1:
             raise ValueError("Can't find course %s" % course_name)
         if len(matches) > 1:
@@ -104,7 +182,8 @@ def main():
 
         # Get information about each of the lectures.  This might return
         # None, if thre is no preview available for the course.
-        lecture_data = get_preview_lectures(course_info, opts.save_lectures)
+        lecture_data = get_preview_lectures(course_info, opts.save_lectures,
+                                            opts.concurrency)
         if lecture_data is None:
             debug("No preview for course %s" % course_info['short_name'])
             if opts.username is None or opts.password is None:
@@ -113,7 +192,8 @@ def main():
                                                 opts.username,
                                                 opts.password,
                                                 instance_info,
-                                                opts.save_lectures)
+                                                opts.save_lectures,
+                                                opts.concurrency)
 
         # Print the course and its lectures in the desired format.
         if opts.xml:
@@ -123,6 +203,18 @@ def main():
         else:
             print texttable(lecture_data)
 
+    debug("Connections: %s" % READURL.connection_stats())
+
+def use_site(site):
+    """
+    Read the list of all courses, and log in, at site (like
+    http://localhost:8080) instead of Coursera.  The course list says
+    where everything else is.
+    """
+    global ALL_URL, AUTH_URL
+    ALL_URL  = site.rstrip('/') + ALL_PATH
+    AUTH_URL = site.rstrip('/') + AUTH_PATH
+
 def getopts():
     """
     parse command line
@@ -145,65 +237,337 @@ def getopts():
                       help='Output XML RSS format')
     parser.add_option('--courses',
                       help='file with full list of courses')
+    parser.add_option('--courses_cache',
+                      help='file to keep a copy of the list of courses in, '
+                      'which is refreshed from Coursera when it changes')
+    parser.add_option('--courses_ttl',
+                      type='int',
+                      default=CATALOG_TTL,
+                      help='seconds before checking if the list of courses '
+                      'has changed')
+    parser.add_option('--size_cache',
+                      help='file to remember the sizes of lecture videos '
+                      'in, so they are not asked for again next time')
+    parser.add_option('--size_ttl',
+                      type='int',
+                      default=SIZE_TTL,
+                      help='seconds before asking for the size of a video '
+                      'again')
+    parser.add_option('--concurrency',
+                      type='int',
+                      default=LECTURE_CONCURRENCY,
+                      help='number of lectures to resolve at once')
+    parser.add_option('--site',
+                      help='read the course list and log in here instead '
+                      'of %s, such as a coursera_stub.py server' % SITE)
+    parser.add_option('--cassette',
+                      help='directory to record responses from Coursera '
+                      'in, or to play them back from (see cassette.py)')
+    parser.add_option('--cassette_mode',
+                      choices=cassette.MODES,
+                      default='replay',
+                      help='record or replay (the default)')
+    parser.add_option('--latency',
+                      type='float',
+                      default=0.0,
+                      help='seconds to wait before each response that is '
+                      'played back')
     opts, args = parser.parse_args()
     if opts.verbose:
         getLogger().setLevel(DEBUG)
 
     return opts, args
 
+# --------------------------------------------------------------------
+# Timing
+
+class NoTimer(object):
+    """
+    Stands in for a timer when nothing is timing us.  A timer has
+    phase(name), a context manager which times one phase of the work
+    (fetch or parse), and bind(func), which makes the phases func times
+    count towards the same work when it runs on another thread.  The
+    podcast app sets TIMER to its instrument module.
+    """
+    @contextmanager
+    def phase(self, name):
+        yield
+
+    def bind(self, func):
+        return func
+
+TIMER = NoTimer()
+
 # --------------------------------------------------------------------
 # Reading and parsing web pages
 
+class ConnectionPool(object):
+    """
+    Keeps HTTP/1.1 connections open after a request, so that the next
+    request to the same host can skip the TCP and TLS handshakes.
+
+    At most size idle connections are kept per host, and connections
+    that have been idle for more than idle_seconds are closed rather
+    than reused.  A connection is only ever used by one request at a
+    time, so the pool can be shared between threads.
+    """
+    def __init__(self, size=POOL_SIZE, idle_seconds=POOL_IDLE_SECONDS):
+        self.size         = size
+        self.idle_seconds = idle_seconds
+        self.idle         = {}
+        self.lock         = threading.Lock()
+        # How many requests went out on an already open connection,
+        # and how many had to open a new one.
+        self.reused       = 0
+        self.created      = 0
+
+    def get(self, scheme, host):
+        """
+        Returns (connection, reused) for the given scheme and host,
+        where reused says whether the connection was already open.
+        """
+        with self.lock:
+            self._evict(time.time())
+            conns = self.idle.get((scheme, host))
+            if conns:
+                self.reused += 1
+                return (conns.pop()[0], True)
+            self.created += 1
+        if scheme == 'https':
+            conn = httplib.HTTPSConnection(host, timeout=HTTP_TIMEOUT)
+        else:
+            conn = httplib.HTTPConnection(host, timeout=HTTP_TIMEOUT)
+        return (conn, False)
+
+    def put(self, scheme, host, conn):
+        """
+        Return a connection to the pool once its response has been
+        completely read.
+        """
+        with self.lock:
+            conns = self.idle.setdefault((scheme, host), [])
+            if len(conns) < self.size:
+                conns.append((conn, time.time()))
+                return
+        conn.close()
+
+    def _evict(self, now):
+        for conns in self.idle.itervalues():
+            while conns and now - conns[0][1] > self.idle_seconds:
+                conns.pop(0)[0].close()
+
+    def close(self):
+        with self.lock:
+            for conns in self.idle.itervalues():
+                for (conn, _) in conns:
+                    conn.close()
+            self.idle = {}
+
+    def stats(self):
+        return {'reused': self.reused, 'created': self.created}
+
+CONNECTION_POOL = ConnectionPool()
+
+# If set, a cassette.Cassette which every ReadUrl without one of its
+# own records its responses to, or plays them back from.
+CASSETTE = None
+
 class ReadUrl(object):
-    def __init__(self):
-        # Make a urllib2 opener that saves cookies
+    def __init__(self, pool=None, cassette=None, proxies=None):
+        # Save cookies in a cookie jar, and send requests over
+        # connections from the (by default, shared) pool, or to the
+        # cassette.
         self.csrftoken = None
         self.session   = None
         self.cj        = cookielib.CookieJar()
-        self.opener    = None
-
-    def set_headers(self, opener, headers):
+        self.pool      = pool if pool is not None else CONNECTION_POOL
+        self.cassette  = cassette
+        # The pool only talks to hosts directly, so requests that have
+        # a proxy (by default, from http_proxy and the like, as with
+        # urllib2) go through urllib2 instead.
+        self.proxies   = urllib.getproxies() if proxies is None else proxies
+        self.proxy_opener = urllib2.OpenerDirector()
+        for handler in (urllib2.ProxyHandler(self.proxies),
+                        urllib2.HTTPHandler(), urllib2.HTTPSHandler()):
+            self.proxy_opener.add_handler(handler)
+        self.proxy_opener.addheaders = [('User-agent', USER_AGENT)]
+
+    def get_headers(self, headers):
+        """
+        Returns the extra (name, value) headers to send for the given
+        headers mode: 'BOTH' sends the csrf token and session cookie,
+        'CSRF' just the csrf token.
+        """
+        extra = []
         if (headers == 'BOTH'
             and self.csrftoken is not None and self.session is not None):
-            opener.addheaders.append(('Cookie', 'csrf_token=%s;session=%s' %
-                                           (self.csrftoken, self.session)))
+            extra.append(('Cookie', 'csrf_token=%s;session=%s' %
+                          (self.csrftoken, self.session)))
         elif ((headers == 'BOTH' or headers == 'CSRF')
               and self.csrftoken is not None):
-            opener.addheaders.append(('Cookie', 'csrftoken=%s' % self.csrftoken))
-            opener.addheaders.append(('Referer', 'https://www.coursera.org'))
-            opener.addheaders.append(('X-CSRFToken', self.csrftoken))
+            extra.append(('Cookie', 'csrftoken=%s' % self.csrftoken))
+            extra.append(('Referer', 'https://www.coursera.org'))
+            extra.append(('X-CSRFToken', self.csrftoken))
+        return extra
 
-    def readurl(self, url, data=None, is_head=False, headers=None):
+    def readurl(self, url, data=None, is_head=False, headers=None,
+                extra_headers=(), until=None):
         """
-        Read a given URL.
+        Read a given URL.  extra_headers is a list of (name, value)
+        headers to send along with the ones for the headers mode.
+
+        until is for when we only need the start of a page: a function
+        which is given the body read so far, and returns true once
+        that's enough.  The rest of the body isn't read, and the
+        response only has what was.
         """
         debug("Reading %s with data %s" % (url, data))
         debug(self.cj)
-        opener = urllib2.build_opener(urllib2.HTTPCookieProcessor(self.cj))
-        if headers is not None:
-            self.set_headers(opener, headers)
-        debug(opener.addheaders)
 
         # Encode any params
         if data is not None:
             data = urllib.urlencode(data)
 
-        # Create the request and open it.  In order to use cookies, we
-        # always use the standard opener to read pages.  An alternative
-        # would have been to set the default opener with
-        #
-        #   urllib2.install_opener(get_opener())
-        #
-        # and then use urllib2.urlopen
         req = urllib2.Request(url, data)
         if is_head:
             req.get_method = lambda : 'HEAD'
-        res = opener.open(req)
+        res = self.open(req, self.get_headers(headers) + list(extra_headers),
+                        until)
         debug(res.headers.items())
         self.save_cookies()
-        opener.close()
         return res
 
+    def open(self, req, extra_headers=(), until=None):
+        """
+        Send a request, following any redirects, and return the final
+        response.  Like urllib2, raises urllib2.HTTPError if the final
+        response isn't a success.  until is as for readurl.
+        """
+        for _ in range(MAX_REDIRECTS + 1):
+            for (name, value) in extra_headers:
+                if not req.has_header(name):
+                    req.add_unredirected_header(name, value)
+            self.cj.add_cookie_header(req)
+            res = self.send(req, until)
+            self.cj.extract_cookies(res, req)
+            location = res.headers.get('location')
+            if res.code in (301, 302, 303, 307) and location is not None:
+                req = self.redirect_request(req, location)
+                continue
+            if not 200 <= res.code < 300:
+                raise urllib2.HTTPError(req.get_full_url(), res.code,
+                                        res.msg, res.headers, res)
+            return res
+        raise urllib2.HTTPError(req.get_full_url(), res.code,
+                                "Too many redirects", res.headers, res)
+
+    def redirect_request(self, req, location):
+        """
+        Make the request for following a redirect.  As with urllib2, a
+        POST becomes a GET, but a HEAD stays a HEAD.
+        """
+        method = req.get_method()
+        newurl = urlparse.urljoin(req.get_full_url(), location)
+        newreq = urllib2.Request(newurl,
+                                 headers=dict(req.headers),
+                                 origin_req_host=req.get_origin_req_host(),
+                                 unverifiable=True)
+        if method == 'HEAD':
+            newreq.get_method = lambda : 'HEAD'
+        return newreq
+
+    def send(self, req, until=None):
+        """
+        Send a single request over a pooled connection and read the
+        whole response, so that the connection can go back to the
+        pool.  If a connection from the pool turns out to have been
+        closed by the server, try again with another one.  A request
+        that has a proxy goes through it instead (see send_proxied).
+
+        With until (see readurl), a successful response may be cut
+        short once it says to stop (see read_body), and then the
+        connection is closed instead.
+
+        With a cassette, the response is recorded, or played back
+        instead of sending the request.  Responses being recorded are
+        read in full.
+        """
+        tape = self.cassette if self.cassette is not None else CASSETTE
+        if tape is not None and tape.replaying:
+            with TIMER.phase('fetch'):
+                return tape.response(req)
+        if tape is not None and tape.recording:
+            until = None
+        scheme = req.get_type()
+        host = req.get_host()
+        headers = dict((name.capitalize(), value)
+                       for (name, value) in req.header_items())
+        headers.setdefault('User-agent', USER_AGENT)
+        if req.has_data():
+            headers.setdefault('Content-type',
+                               'application/x-www-form-urlencoded')
+        if self.is_proxied(scheme, host):
+            (status, reason, msg, body) = self.send_proxied(req, until)
+        else:
+            while True:
+                (conn, reused) = self.pool.get(scheme, host)
+                try:
+                    with TIMER.phase('fetch'):
+                        conn.request(req.get_method(), req.get_selector(),
+                                     req.get_data(), headers)
+                        resp = conn.getresponse()
+                        (body, complete) = read_body(resp, until)
+                except (httplib.HTTPException, socket.error):
+                    conn.close()
+                    if reused:
+                        continue
+                    raise
+                if resp.will_close or not complete:
+                    conn.close()
+                else:
+                    self.pool.put(scheme, host, conn)
+                (status, reason, msg) = (resp.status, resp.reason, resp.msg)
+                break
+        if tape is not None and tape.recording:
+            tape.record(req, status, reason, msg, body)
+        return cassette.make_response(req, status, reason, msg, body)
+
+    def is_proxied(self, scheme, host):
+        """
+        Whether requests to host should go through a proxy.
+        """
+        return scheme in self.proxies and not urllib.proxy_bypass(host)
+
+    def send_proxied(self, req, until=None):
+        """
+        Send a single request through its proxy, with urllib2, and
+        return (status, reason, headers, body).  Connections to the
+        proxy aren't kept, so with until, a successful response is
+        read only until it says to stop.
+        """
+        with TIMER.phase('fetch'):
+            resp = self.proxy_opener.open(req, timeout=HTTP_TIMEOUT)
+            try:
+                if until is None or not 200 <= resp.code < 300:
+                    body = resp.read()
+                else:
+                    body = ''
+                    while True:
+                        chunk = resp.read(SCAN_CHUNK)
+                        body += chunk
+                        if not chunk or until(body):
+                            break
+            finally:
+                resp.close()
+        return (resp.code, resp.msg, resp.info(), body)
+
+    def connection_stats(self):
+        """
+        Returns how many requests reused an open connection and how
+        many needed a new one.
+        """
+        return self.pool.stats()
+
     def save_cookies(self):
         """
         This isn't really correct.  The cookies are associated with
@@ -227,10 +591,103 @@ class ReadUrl(object):
         Parse a given URL with Beautiful Soup.  Seems to sometimes have
         trouble with lxml, so force it to use html.parser.
         """
-        return BeautifulSoup(self.readurl(url, headers=headers), 'html.parser')
+        return self.parse(self.readurl(url, headers=headers))
+
+    def parse(self, markup, parse_only=None):
+        """
+        Parse a page (a string or file) that has already been read.
+        With parse_only (a bs4.SoupStrainer), only the parts of the
+        page it matches are kept.
+        """
+        from bs4 import BeautifulSoup
+        with TIMER.phase('parse'):
+            return BeautifulSoup(markup, 'html.parser', parse_only=parse_only)
+
+def read_body(resp, until=None):
+    """
+    Read the body of an httplib response, or with until (see
+    ReadUrl.readurl), only as much of a successful one as it takes.
+    Returns (body, complete), where complete says whether all of it
+    was read.
+
+    A response is only cut short if that saves reading at least
+    SCAN_SKIP bytes, or its connection can't be reused anyway.
+    Otherwise it's read to the end, so the connection can go back to
+    the pool.  resp.length is what's left of its Content-Length, or
+    None if it didn't say.
+    """
+    if until is None or not 200 <= resp.status < 300:
+        return (resp.read(), True)
+    if (resp.length is not None and resp.length < SCAN_SKIP
+        and not resp.will_close):
+        return (resp.read(), True)
+    body = ''
+    found = False
+    while True:
+        chunk = resp.read(SCAN_CHUNK)
+        if not chunk:
+            return (body, True)
+        body += chunk
+        found = found or bool(until(body))
+        if not found:
+            continue
+        if resp.will_close:
+            return (body, resp.isclosed())
+        if resp.length is not None:
+            if resp.length < SCAN_SKIP:
+                return (body + resp.read(), True)
+            return (body, resp.isclosed())
+        if len(body) >= SCAN_SKIP:
+            return (body, resp.isclosed())
 
 READURL=ReadUrl()
 
+# --------------------------------------------------------------------
+# Running things in parallel
+
+def parallel_map(func, items, concurrency=1):
+    """
+    Call func on each of the items, using up to concurrency threads.
+
+    Returns a list with one (result, error) pair per item, in the same
+    order as items.  If func raised an exception for an item, result
+    is None and error is the exception, so one bad item doesn't stop
+    the others.
+    """
+    results = [None] * len(items)
+    func = TIMER.bind(func)
+    if concurrency <= 1 or len(items) <= 1:
+        for ii in range(len(items)):
+            results[ii] = _call_isolated(func, items[ii])
+        return results
+
+    work = Queue.Queue()
+    for ii in range(len(items)):
+        work.put(ii)
+
+    def worker():
+        while True:
+            try:
+                ii = work.get_nowait()
+            except Queue.Empty:
+                return
+            results[ii] = _call_isolated(func, items[ii])
+
+    threads = [threading.Thread(target=worker)
+               for _ in range(min(concurrency, len(items)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+def _call_isolated(func, item):
+    try:
+        return (func(item), None)
+    except Exception as e:
+        return (None, e)
+
 # --------------------------------------------------------------------
 # Formatting text
 
@@ -251,36 +708,317 @@ def texttable(table, delim=' '):
 # Functions for course list
 #
 
+class CatalogCache(object):
+    """
+    Holds the list of all courses, so that it isn't downloaded and
+    parsed again for every course we look up.
+
+    The list is downloaded from url at most once every ttl seconds,
+    and then with the ETag and Last-Modified of the last download, so
+    that Coursera only sends it again if it has changed.  If path is
+    given, the list is also saved there, with those validators in
+    path + '.meta', so that the next run can start from it.
+
+    With no url, path is just a saved copy of the list (like
+    course-list.20130318), which is read again only if it changes.
+    """
+    def __init__(self, path=None, url=ALL_URL, ttl=CATALOG_TTL, readurl=None):
+        self.path          = path
+        self.url           = url
+        self.ttl           = ttl
+        self.readurl       = readurl
+        self.courses_list  = None
+        self.etag          = None
+        self.last_modified = None
+        # When we last downloaded the list or checked that it was current
+        self.checked       = None
+        self.lock          = threading.Lock()
+        self.course_catalog = None
+
+    def courses(self):
+        """
+        Return the list of all courses.
+        """
+        with self.lock:
+            if self.url is None:
+                mtime = os.path.getmtime(self.path)
+                if self.courses_list is None or mtime != self.checked:
+                    with open(self.path) as fd:
+                        with TIMER.phase('parse'):
+                            self.courses_list = list(iter_courses(fd))
+                    self.checked = mtime
+                return self.courses_list
+
+            if self.courses_list is None and self.path is not None:
+                self.load()
+            now = time.time()
+            if self.checked is None or now - self.checked >= self.ttl:
+                try:
+                    self.revalidate(now)
+                except (urllib2.URLError, httplib.HTTPException,
+                        socket.error) as e:
+                    if self.courses_list is None:
+                        raise
+                    warning("Can't refresh course list, using old one: %s"
+                            % e)
+            return self.courses_list
+
+    def catalog(self):
+        """
+        Return a CourseCatalog for the list of all courses, which is
+        only rebuilt when the list changes.
+        """
+        courses = self.courses()
+        with self.lock:
+            if (self.course_catalog is None
+                or self.course_catalog.courses is not courses):
+                self.course_catalog = CourseCatalog(courses)
+            return self.course_catalog
+
+    def revalidate(self, now):
+        """
+        Download the list of courses, unless Coursera says our copy is
+        still current.
+        """
+        headers = []
+        if self.courses_list is not None:
+            if self.etag is not None:
+                headers.append(('If-None-Match', self.etag))
+            if self.last_modified is not None:
+                headers.append(('If-Modified-Since', self.last_modified))
+        readurl = self.readurl if self.readurl is not None else READURL
+        try:
+            res = readurl.readurl(self.url, extra_headers=headers)
+        except urllib2.HTTPError as e:
+            if e.code != 304 or self.courses_list is None:
+                raise
+            debug("Course list has not changed")
+            self.checked = now
+            self.save_meta()
+            return
+        body = res.read()
+        with TIMER.phase('parse'):
+            self.courses_list = list(iter_courses(StringIO(body)))
+        self.etag = res.headers.get('ETag')
+        self.last_modified = res.headers.get('Last-Modified')
+        self.checked = now
+        if self.path is not None:
+            write_file(self.path, body)
+            self.save_meta()
+
+    def load(self):
+        """
+        Read the saved copy of the list of courses, if there is one.
+        """
+        if not os.path.exists(self.path):
+            return
+        meta = {}
+        if os.path.exists(self.path + '.meta'):
+            with open(self.path + '.meta') as fd:
+                meta = json.load(fd)
+        with open(self.path) as fd:
+            with TIMER.phase('parse'):
+                self.courses_list = list(iter_courses(fd))
+        self.etag          = meta.get('etag')
+        self.last_modified = meta.get('last_modified')
+        self.checked       = meta.get('checked')
+
+    def save_meta(self):
+        if self.path is None:
+            return
+        write_file(self.path + '.meta', json.dumps({
+            'etag': self.etag,
+            'last_modified': self.last_modified,
+            'checked': self.checked,
+            }))
+
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+def iter_courses(fd, chunk_size=64 * 1024, fields=True):
+    """
+    Read a list of all courses (in the format of ALL_URL) from a file
+    object, and yield the courses one at a time, as they are read.
+    Unless fields is False, each course only has the COURSE_FIELDS
+    and INSTANCE_FIELDS (see project_course).
+
+    Unlike json.load, this never holds more than a chunk of the file
+    and one whole course in memory at once.
+    """
+    decoder = json.JSONDecoder()
+    buf = ''
+    pos = 0
+    started = False
+    while True:
+        pos = WHITESPACE.match(buf, pos).end()
+        if pos == len(buf):
+            more = fd.read(chunk_size)
+            if more == '':
+                raise ValueError("Course list ended early")
+            buf = buf[pos:] + more
+            pos = 0
+            continue
+        if not started:
+            if buf[pos] != '[':
+                raise ValueError("Course list is not a JSON list")
+            started = True
+            pos += 1
+        elif buf[pos] == ']':
+            return
+        elif buf[pos] == ',':
+            pos += 1
+        else:
+            try:
+                (course, end) = decoder.raw_decode(buf, pos)
+            except ValueError:
+                # Probably just the end of the buffer in the middle of
+                # a course, so read some more and try again.
+                more = fd.read(chunk_size)
+                if more == '':
+                    raise
+                buf = buf[pos:] + more
+                pos = 0
+                continue
+            pos = end
+            if pos >= chunk_size:
+                buf = buf[pos:]
+                pos = 0
+            yield project_course(course) if fields else course
+
+def project_course(course):
+    """
+    Returns a copy of the JSON for a course with only the fields we
+    use, COURSE_FIELDS, and INSTANCE_FIELDS for each of its instances.
+    """
+    projected = dict((field, course.get(field)) for field in COURSE_FIELDS)
+    projected['courses'] = [
+        dict((field, instance.get(field)) for field in INSTANCE_FIELDS)
+        for instance in course.get('courses') or []]
+    return projected
+
+def write_file(path, data):
+    """
+    Write data to path, replacing it all at once so that a reader
+    never sees half a file.
+    """
+    tmp = '%s.tmp%d' % (path, os.getpid())
+    with open(tmp, 'wb') as fd:
+        fd.write(data)
+    os.rename(tmp, path)
+
+CATALOG_CACHES = {}
+CATALOG_CACHES_LOCK = threading.Lock()
+
+def catalog_cache(courses_file=None):
+    """
+    Return the CatalogCache for courses_file, which may be the name of
+    a saved copy of the list of courses, None for the list on
+    Coursera's website, or a CatalogCache to use as is.
+    """
+    if isinstance(courses_file, CatalogCache):
+        return courses_file
+    with CATALOG_CACHES_LOCK:
+        if courses_file not in CATALOG_CACHES:
+            if courses_file is None:
+                cache = CatalogCache(url=ALL_URL)
+            else:
+                cache = CatalogCache(courses_file, url=None)
+            CATALOG_CACHES[courses_file] = cache
+        return CATALOG_CACHES[courses_file]
+
+class CourseCatalog(object):
+    """
+    The list of all courses, indexed so that we can look up courses
+    without searching the whole list.
+
+    Courses are indexed by short_name, by the names of their instances
+    (the progfun-2012-001 in https://class.coursera.org/progfun-2012-001/),
+    by university id and by category id.
+    """
+    def __init__(self, courses):
+        self.courses       = courses
+        self.by_short_name = {}
+        self.by_instance   = {}
+        self.by_university = {}
+        self.by_category   = {}
+        self.current       = {}
+        for course in courses:
+            self.by_short_name.setdefault(course['short_name'], []).append(course)
+            for university in course.get('university-ids') or []:
+                self.by_university.setdefault(university, []).append(course)
+            for category in course.get('category-ids') or []:
+                self.by_category.setdefault(category, []).append(course)
+            seen = set()
+            for instance in course['courses']:
+                slug = instance_name(instance)
+                if slug is None or slug in seen:
+                    continue
+                seen.add(slug)
+                self.by_instance.setdefault(slug, []).append((course, instance))
+            self.current[id(course)] = get_current_instance(course)
+
+    def find(self, name):
+        """
+        Returns a list of (course, instance) pairs for the given name,
+        which can be a course short_name (giving the current instance
+        of the course), or the name of a particular instance.
+        """
+        if name in self.by_short_name:
+            return [(course, self.current_instance(course))
+                    for course in self.by_short_name[name]]
+        return list(self.by_instance.get(name, []))
+
+    def current_instance(self, course_info):
+        """
+        Same as get_current_instance, but already worked out for each
+        course in the catalog.
+        """
+        if id(course_info) in self.current:
+            return self.current[id(course_info)]
+        return get_current_instance(course_info)
+
+    def university(self, university_id):
+        return self.by_university.get(university_id, [])
+
+    def category(self, category_id):
+        return self.by_category.get(category_id, [])
+
+def course_catalog(courses_file=None):
+    """
+    Return a CourseCatalog of all courses.  courses_file is the same
+    as for all_courses.
+    """
+    return catalog_cache(courses_file).catalog()
+
 def all_courses(courses_file=None):
     """
     Return the JSON from reading the list of all courses from
-    Coursera's website.
+    Coursera's website.  The list is cached (see CatalogCache), so
+    don't modify it.
     """
-    if courses_file is None:
-        data = READURL.readurl(ALL_URL)
-    else:
-        data = open(courses_file)
-    return json.load(data)
+    return catalog_cache(courses_file).courses()
 
 def print_course_list(courses_file=None):
     """
     Download the list of all courses, and print each course's short
     name
     """
-    courses = all_courses(courses_file=courses_file)
+    catalog = course_catalog(courses_file=courses_file)
+    courses = catalog.courses
     lines = []
     for ii in range(len(courses)):
         course_info = courses[ii]
+        current = catalog.current_instance(course_info)
         # Each course could be offered many times, like every year or
         # every few months.  So each course has many instances, and
         # each instance could have its own course webpage and
-        # materials.
+        # materials.  The current one is marked with a *.
         for instance in course_info['courses']:
             lines.append([str(ii),
                           str(course_info['short_name']),
                           '%s/%s' % (instance['start_month'],
                                      instance['start_year']),
                           "ACTIVE" if instance['active'] else 'INACTIVE',
+                          '*' if instance is current else '',
                           str(instance['home_link']),
                           str(course_info['preview_link'])])
         if len(course_info['courses']) == 0:
@@ -288,10 +1026,131 @@ def print_course_list(courses_file=None):
                           str(course_info['short_name']),
                           'None',
                           "INACTIVE",
+                          '',
                           "No-instance",
                           str(course_info['preview_link'])])
     print texttable(lines)
 
+# --------------------------------------------------------------------
+# Video sizes
+
+class SizeCache(object):
+    """
+    Remembers the sizes of lecture videos, by url, so that reading a
+    course again doesn't need a HEAD request for every video.  A video
+    keeps its size once it's published, so sizes are kept for ttl
+    seconds.  Videos that couldn't be found are remembered too, for
+    miss_ttl seconds, so that a broken lecture isn't asked for on
+    every read either.
+
+    Entries are kept in memory, and in store (if given), which has
+    load(urls), returning a dict of url -> (size, checked) for those
+    of urls it has, and save(entries), saving such a dict.  checked
+    is when the size was read, in seconds since the epoch, and size
+    is None for a video that couldn't be found.  Entries are loaded
+    by preload, a page's worth at a time, or by get, one at a time,
+    and new entries are only saved by flush.
+    """
+    def __init__(self, store=None, ttl=SIZE_TTL, miss_ttl=SIZE_MISS_TTL):
+        self.store    = store
+        self.ttl      = ttl
+        self.miss_ttl = miss_ttl
+        self.entries  = {}
+        # Entries that haven't been saved to the store yet
+        self.unsaved  = {}
+        # Urls already asked of the store, whether it had them or not
+        self.loaded   = set()
+        self.lock     = threading.Lock()
+
+    def preload(self, urls):
+        """
+        Load the entries for urls from the store, in one go, so that
+        get doesn't have to ask for them one at a time.
+        """
+        if self.store is None:
+            return
+        with self.lock:
+            urls = [url for url in set(urls) if url not in self.loaded]
+        if not urls:
+            return
+        entries = self.store.load(urls)
+        with self.lock:
+            self.loaded.update(urls)
+            for (url, entry) in entries.items():
+                self.entries.setdefault(url, entry)
+
+    def get(self, url, now=None):
+        """
+        Returns (found, size).  found is False if we don't know the
+        size of url, or haven't checked it for too long.  Otherwise
+        size is its size, or None if it couldn't be found.
+        """
+        if now is None:
+            now = time.time()
+        with self.lock:
+            entry = self.entries.get(url)
+            loaded = url in self.loaded
+        if entry is None and not loaded:
+            self.preload([url])
+            with self.lock:
+                entry = self.entries.get(url)
+        if entry is None:
+            return (False, None)
+        (size, checked) = entry
+        ttl = self.ttl if size is not None else self.miss_ttl
+        if now - checked >= ttl:
+            return (False, None)
+        return (True, size)
+
+    def set(self, url, size, now=None):
+        """
+        Remember the size of url, or with size None, that it couldn't
+        be found.
+        """
+        if now is None:
+            now = time.time()
+        with self.lock:
+            self.entries[url] = (size, now)
+            self.unsaved[url] = (size, now)
+
+    def flush(self):
+        """
+        Save the entries added since the last flush to the store.
+        """
+        with self.lock:
+            unsaved = self.unsaved
+            self.unsaved = {}
+        if unsaved and self.store is not None:
+            self.store.save(unsaved)
+
+class FileSizeStore(object):
+    """
+    A SizeCache store which keeps its entries in a JSON file.
+    """
+    def __init__(self, path):
+        self.path    = path
+        self.entries = {}
+        self.lock    = threading.Lock()
+        if os.path.exists(path):
+            with open(path) as fd:
+                self.entries = dict((url, tuple(entry))
+                                    for (url, entry) in json.load(fd).items())
+
+    def load(self, urls):
+        with self.lock:
+            return dict((url, self.entries[url]) for url in urls
+                        if url in self.entries)
+
+    def save(self, entries):
+        with self.lock:
+            self.entries.update(entries)
+            write_file(self.path, json.dumps(self.entries, indent=1,
+                                             sort_keys=True))
+
+# If set, a SizeCache that get_video_info looks up the sizes of videos
+# in before asking for them.
+SIZE_CACHE = None
+
 # --------------------------------------------------------------------
 # Functions for a specific course, previews
 #
@@ -301,20 +1160,7 @@ def find_course(short_name, courses_file=None):
     Returns a list of courses matching the given course short_name.
     We expect no more than one match, but return a list to be safe.
     """
-    courselist = all_courses(courses_file)
-    matches = [course for course in courselist
-               if course['short_name'] == short_name]
-    if len(matches) == 0:
-        for course in courselist:
-            for instance in course['courses']:
-                if match_instance(instance, short_name):
-                    matches.append((course, instance))
-                    break
-    else:
-        matches = [(course, get_current_instance(course))
-                   for course in matches]
-
-    return matches
+    return course_catalog(courses_file).find(short_name)
 
 def match_instance(instance, name):
     """
@@ -327,24 +1173,55 @@ def match_instance(instance, name):
     https://class.coursera.org/progfun-2012-001/assignment/index.  So
     we have to match progfun-2012-001 with the home_link.
     """
-    urlmatch = '/{0}/'.format(name)
-    return instance['home_link'].find(urlmatch) >= 0
+    return instance_name(instance) == name
+
+def instance_name(instance):
+    """
+    Returns the name of a course instance, which is the first part of
+    the path of its home_link (see match_instance), or None if it
+    doesn't have one.
+    """
+    path = urlparse.urlparse(instance['home_link'] or '').path
+    parts = [part for part in path.split('/') if part != '']
+    if len(parts) == 0:
+        return None
+    return parts[0]
 
-def get_lecture_info(lectures_url, readurl=None, save_lectures=None):
+def get_lecture_info(lectures_url, readurl=None, save_lectures=None,
+                     concurrency=None, failed=None):
     """
     Given a Coursera url which inludes the listing of all the
     lectures, parse the page and just a list of the relevant info
-    about each lecture.
+    about each lecture:
+
+      [name, duration, size, mp4url, description, resources, lecture_id]
+
+    lecture_id is Coursera's id for the lecture (its data-lecture-id),
+    which stays the same when lectures are added or moved around.
+
+    Finding the video url and size of each lecture takes two more
+    requests per lecture (one, if the size is in SIZE_CACHE), so those
+    are done by a pool of up to concurrency threads: first all the
+    video urls, then, after looking their sizes up in SIZE_CACHE all
+    at once, the sizes it didn't have.  The lectures are still
+    returned in the order they appear on the page.  A lecture whose
+    video can't be found is logged and left out, rather than failing
+    the whole page.  If failed is a list, each lecture left out is
+    added to it as (position, lecture), where position is where in
+    the returned list it would have gone, and lecture has None for
+    its size and mp4url.  So a caller can tell a lecture that's gone
+    from one that we just couldn't read this time.
     """
     if readurl is None:
         readurl=READURL
+    if concurrency is None:
+        concurrency = LECTURE_CONCURRENCY
 
+    pagehtml = readurl.readurl(lectures_url, headers="BOTH").read()
     if save_lectures is not None:
-        pagehtml = readurl.readurl(lectures_url, headers="BOTH")
         with open(save_lectures, 'w') as fd:
-            fd.write(pagehtml.read())
-
-    page = readurl.bsoup(lectures_url, headers="BOTH")
+            fd.write(pagehtml)
+    page = parse_lecture_index(pagehtml, readurl)
 
     # Go through all the links.  The lecture links are tagged with the
     # class 'lecture-link'.  They look like this:
@@ -352,7 +1229,7 @@ def get_lecture_info(lectures_url, readurl=None, save_lectures=None):
     # <a class="lecture-link" data-lecture-id="124" data-modal=".course-modal-frame" data-modal-iframe="https://class.coursera.org/nlp/lecture/preview_view?lecture_id=124" href="https://class.coursera.org/nlp/lecture/preview_view/124" rel="lecture-link">
     # Course Introduction (14:11)</a>
     #
-    lectures = []
+    links = []
     name_re = '^(.*)[\(\[](\d+:\d+)[\)\]]$'
 
     weeks = page.find_all('div', attrs={'class': 'course-item-list-header'})
@@ -361,6 +1238,7 @@ def get_lecture_info(lectures_url, readurl=None, save_lectures=None):
         lecture_list = week.next_sibling
         for link in lecture_list.find_all('a', attrs={'class': 'lecture-link'}):
             vidlink = link['data-modal-iframe']
+            lecture_id = link.get('data-lecture-id', '')
             # strip because video names tend to start with a \n
             vidtext = link.text.strip()
             match = re.match(name_re, vidtext)
@@ -369,10 +1247,6 @@ def get_lecture_info(lectures_url, readurl=None, save_lectures=None):
             else:
                 name = vidtext
                 duration = ''
-            vidpage = readurl.bsoup(vidlink)
-            mp4url = vidpage.find('source', attrs={'type': 'video/mp4'})['src']
-            vidinfo = readurl.readurl(mp4url, is_head=True)
-            size = vidinfo.headers['Content-Length']
             description = "%s : %s" % (week_desc, name)
             full_name = "%s - %s" % (week_desc[:13], name)
             resources = {}
@@ -384,25 +1258,167 @@ def get_lecture_info(lectures_url, readurl=None, save_lectures=None):
                     title = resource['title'].encode('ascii', 'ignore')
                     href = resource['href'].encode('ascii', 'ignore')
                     resources[title] = href
-            lectures.append([full_name, duration, size, mp4url,
-                             description, resources])
+            links.append((vidlink, full_name, duration, description,
+                          resources, lecture_id))
+
+    urls = parallel_map(lambda link: get_video_url(link[0], readurl),
+                        links, concurrency)
+    found = [mp4url for (mp4url, error) in urls if error is None]
+    if SIZE_CACHE is not None:
+        SIZE_CACHE.preload(found)
+    sizes = iter(parallel_map(lambda mp4url: get_video_size(mp4url, readurl),
+                              found, concurrency))
+    if SIZE_CACHE is not None:
+        SIZE_CACHE.flush()
+    videos = []
+    for (mp4url, error) in urls:
+        if error is None:
+            (size, error) = next(sizes)
+        videos.append(((mp4url, size) if error is None else None, error))
 
-    for lec in lectures:
-        for ii in range(len(lec)-1):
-            lec[ii] = lec[ii].encode('ascii', 'ignore')
+    lectures = []
+    for (link, (video, error)) in zip(links, videos):
+        (vidlink, full_name, duration, description, resources,
+         lecture_id) = link
+        if error is not None:
+            warning("Skipping lecture %s (%s): %s" % (full_name, vidlink, error))
+            if failed is not None:
+                failed.append((len(lectures),
+                               [full_name, duration, None, None, description,
+                                resources, lecture_id]))
+            continue
+        (mp4url, size) = video
+        lectures.append([full_name, duration, size, mp4url,
+                         description, resources, lecture_id])
+
+    for lec in lectures + [lec for (_, lec) in failed or []]:
+        for ii in range(len(lec)):
+            if isinstance(lec[ii], basestring):
+                lec[ii] = lec[ii].encode('ascii', 'ignore')
 
     return lectures
 
-def get_preview_lectures(course_info, save_lectures=None):
+def parse_lecture_index(pagehtml, readurl=READURL):
+    """
+    Parse a lecture index page.  Only the week headers and the lists of
+    lectures after them are built into the soup (see
+    LECTURE_INDEX_CLASSES), which roughly halves the memory the soup
+    takes.  It doesn't make parsing much quicker, since html.parser
+    still has to tokenize the whole page.  If that finds no weeks, the
+    page doesn't look the way we expect, so it's parsed in full.
+    """
+    from bs4 import SoupStrainer
+    strainer = SoupStrainer(['div', 'ul'],
+                            attrs={'class': is_lecture_index_class})
+    page = readurl.parse(pagehtml, parse_only=strainer)
+    headers = page.find_all('div', attrs={'class': LECTURE_INDEX_CLASSES[0]})
+    if len(headers) > 0 and all(header.next_sibling is not None
+                                for header in headers):
+        return page
+    debug("Lecture index isn't laid out as expected, parsing all of it")
+    return readurl.parse(pagehtml)
+
+def is_lecture_index_class(value):
+    """
+    Whether a class attribute has one of LECTURE_INDEX_CLASSES.  While
+    the page is being parsed, it's the attribute as written, which can
+    hold several classes ("course-item-list-header expanded").
+    """
+    if value is None:
+        return False
+    return any(name in LECTURE_INDEX_CLASSES for name in value.split())
+
+def video_source(page):
+    """
+    The src of the first <source type="video/mp4"> tag in a video page
+    (or as much of one as has been read), or None.  This is a lot
+    quicker than parsing the page, but only finds plainly written
+    tags, so get_video_info parses the page when it finds nothing.
+    """
+    page = COMMENT_RE.sub('', page)
+    # Skip a comment that hasn't all been read yet
+    page = page.split('<!--', 1)[0]
+    for tag in SOURCE_TAG_RE.finditer(page):
+        attrs = {}
+        for match in ATTRIBUTE_RE.finditer(tag.group(1)):
+            (name, double, single, bare) = match.groups()
+            value = next(value for value in (double, single, bare)
+                         if value is not None)
+            attrs.setdefault(name.lower(), value)
+        if attrs.get('type', '').lower() == 'video/mp4' and attrs.get('src'):
+            # Unicode, like BeautifulSoup gives us
+            return HTMLParser().unescape(attrs['src'].decode('utf-8',
+                                                             'replace'))
+    return None
+
+def get_video_info(vidlink, readurl=None):
+    """
+    Given the url of a lecture's video page (the iframe that pops up
+    when you click on a lecture), return the url of the mp4 video and
+    its size in bytes.
+    """
+    mp4url = get_video_url(vidlink, readurl)
+    return (mp4url, get_video_size(mp4url, readurl))
+
+def get_video_url(vidlink, readurl=None):
+    """
+    Given the url of a lecture's video page, return the url of the mp4
+    video.  The page is only read as far as the mp4 <source> tag.  If
+    that can't be found without parsing the page, it has all been
+    read, and is parsed.
+    """
+    if readurl is None:
+        readurl=READURL
+    page = readurl.readurl(vidlink, until=video_source).read()
+    mp4url = video_source(page)
+    if mp4url is None:
+        debug("No mp4 <source> found in %s, parsing it" % vidlink)
+        vidpage = readurl.parse(page)
+        mp4url = vidpage.find('source', attrs={'type': 'video/mp4'})['src']
+    return mp4url
+
+def get_video_size(mp4url, readurl=None):
+    """
+    Return the size in bytes of the mp4 video at mp4url.  The size is
+    looked up in SIZE_CACHE, if there is one, before asking for it
+    with a HEAD request.
+    """
+    if readurl is None:
+        readurl=READURL
+    if SIZE_CACHE is not None:
+        (found, size) = SIZE_CACHE.get(mp4url)
+        if found:
+            if size is None:
+                raise urllib2.URLError("%s couldn't be found when last "
+                                       "checked" % mp4url)
+            return size
+    try:
+        vidinfo = readurl.readurl(mp4url, is_head=True)
+    except urllib2.HTTPError as e:
+        # Not there (404) or not allowed (403), rather than Coursera
+        # having trouble, so it's no use asking again for a while
+        if SIZE_CACHE is not None and 400 <= e.code < 500:
+            SIZE_CACHE.set(mp4url, None)
+        raise
+    size = vidinfo.headers['Content-Length']
+    if SIZE_CACHE is not None:
+        SIZE_CACHE.set(mp4url, size)
+    return size
+
+def get_preview_lectures(course_info, save_lectures=None, concurrency=None,
+                         failed=None):
     """
     Given the JSON information about a course, get the lectures from
-    the course's preview page.
+    the course's preview page.  failed is as for get_lecture_info.
     """
     if course_info['preview_link'] is None:
         return None
     if course_info['preview_link'] == "":
         return None
-    return get_lecture_info(course_info['preview_link'], save_lectures)
+    return get_lecture_info(course_info['preview_link'],
+                            save_lectures=save_lectures,
+                            concurrency=concurrency,
+                            failed=failed)
 
 # --------------------------------------------------------------------
 # Functions for a specific course, login required
@@ -444,9 +1460,11 @@ def get_current_instance(course_info):
         return instances[-1]
 
 def get_current_lectures(course_info, username, password,
-                         instance_info=None, save_lectures=None):
+                         instance_info=None, save_lectures=None,
+                         concurrency=None, failed=None):
     """
-    Get the current set of lectures for a given course.
+    Get the current set of lectures for a given course.  failed is as
+    for get_lecture_info.
 
     Note, it seems that once you get the lecture urls, you can
     download the videos without logging in.
@@ -458,7 +1476,8 @@ def get_current_lectures(course_info, username, password,
     # where the suffix indicates which instance of the course this is
     home = instance_info['home_link']
     readurl = login(home, username, password)
-    return get_lecture_info(home + LECTURES_PATH, readurl, save_lectures)
+    return get_lecture_info(home + LECTURES_PATH, readurl, save_lectures,
+                            concurrency, failed)
 
 # --------------------------------------------------------------------
 # Functions for outputting XML RSS information
@@ -506,7 +1525,7 @@ def rss_lecture_info(course_info, lecture_data):
                                  '%Y%m%d %H:%M:%S')
     oneday = timedelta(days=1)
     for lecture in lecture_data:
-        (name, duration, size, mp4url, description, _) = lecture
+        (name, duration, size, mp4url, description, _, _) = lecture
         rss_lectures.append('''
 <item>
 <title>{0}</title>
@@ -585,7 +1604,7 @@ def html_footer():
 def html_lecture_info(lecture_data):
     lectures = []
     for lecture in lecture_data:
-        (name, duration, size, mp4url, description, resources) = lecture
+        (name, duration, size, mp4url, description, resources, _) = lecture
         row = '''
 <tr>
 <td>{0}</td>
@@ -0,0 +1,463 @@
+#!/usr/bin/env python
+"""
+A local stand-in for the parts of Coursera that coursera_rss.py and
+coursera_dl.py read, for trying them out at scale (and timing them)
+without going near Coursera.
+
+ coursera_stub.py [--port 8080] [--courses 20] [--weeks 10] [--lectures 8]
+
+serves made up courses, each with weeks x lectures lectures:
+
+ /maestro/api/topic/list        the list of all courses (with an ETag)
+ /<course>/lecture/preview      a course's lecture index (the preview)
+ /<course>-001/lecture/index    the same, for the current instance,
+                                which also sets a csrf_token cookie
+ /<course>/lecture/preview_view?lecture_id=N
+                                a lecture's video page
+ /maestro/api/user/login        login (POST), which wants the csrf
+                                token in X-CSRFToken
+ /<course>-001/auth/auth_redirector
+                                sets a session cookie, and redirects to
+                                the lecture index
+ /videos/<course>/<N>.mp4       the videos, --video_size bytes of
+ /<course>-001/lecture/download.mp4?lecture_id=N
+                                junk each, which also answer HEAD and
+                                Range requests
+
+Any username and password log in, and the pages don't check for the
+cookies.  To use it, point the scripts at it with --site:
+
+ coursera_rss.py --site http://localhost:8080 stub001
+ coursera_dl.py --site http://localhost:8080 -u me -p pw stub001-001
+
+Each response waits --latency seconds first, bodies are sent at no
+more than --bandwidth bytes a second, and --error_rate of the
+requests get a 503 instead.  The pages are padded with navigation,
+scripts and a footer to about the size of Coursera's.
+"""
+
+import BaseHTTPServer
+import hashlib
+import json
+from   optparse import OptionParser
+import random
+import re
+import SocketServer
+import threading
+import time
+import urllib
+import urlparse
+
+# The pieces bodies are sent in, so that --bandwidth can pace them
+CHUNK_SIZE = 16 * 1024
+# One block of the junk videos are made of
+VIDEO_BLOCK = ''.join(chr(ii % 251) for ii in range(64 * 1024))
+
+# --------------------------------------------------------------------
+# Main and command line arguments
+
+def main():
+    opts, _ = getopts()
+    server = StubServer(('', opts.port), opts)
+    print "Serving %d courses on http://localhost:%d/" % (opts.courses,
+                                                         opts.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+def getopts(args=None):
+    """
+    parse command line
+    """
+    parser = OptionParser()
+    parser.add_option('--port',
+                      type='int',
+                      default=8080,
+                      help='port to serve on')
+    parser.add_option('--courses',
+                      type='int',
+                      default=20,
+                      help='how many courses to list')
+    parser.add_option('--weeks',
+                      type='int',
+                      default=10,
+                      help='weeks of lectures in each course')
+    parser.add_option('--lectures',
+                      type='int',
+                      default=8,
+                      help='lectures in each week')
+    parser.add_option('--video_size',
+                      type='int',
+                      default=1024 * 1024,
+                      help='bytes in each video')
+    parser.add_option('--padding',
+                      type='int',
+                      default=60 * 1024,
+                      help='bytes of navigation, scripts and footer to '
+                      'pad each lecture index page with')
+    parser.add_option('--latency',
+                      type='float',
+                      default=0.0,
+                      help='seconds to wait before each response')
+    parser.add_option('--bandwidth',
+                      type='int',
+                      default=0,
+                      help='bytes per second to send bodies at '
+                      '(0 for as fast as possible)')
+    parser.add_option('--error_rate',
+                      type='float',
+                      default=0.0,
+                      help='fraction of requests that fail with a 503')
+    parser.add_option('--seed',
+                      type='int',
+                      help='seed for which requests fail')
+    return parser.parse_args(args)
+
+# --------------------------------------------------------------------
+# The server
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Serves the made up site described by opts (see getopts), a thread
+    per connection.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, opts):
+        BaseHTTPServer.HTTPServer.__init__(self, address, StubHandler)
+        self.opts   = opts
+        self.random = random.Random(opts.seed)
+        self.lock   = threading.Lock()
+        self.catalog = json.dumps(topic_list(self.base_url(), opts))
+        self.catalog_etag = '"%s"' % hashlib.md5(self.catalog).hexdigest()
+
+    def base_url(self):
+        return 'http://localhost:%d' % self.server_port
+
+    def should_fail(self):
+        with self.lock:
+            return self.random.random() < self.opts.error_rate
+
+    def start(self):
+        """
+        Serve on a background thread, for tests and benchmarks.
+        """
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    # (method, path pattern, handler method name)
+    ROUTES = (
+        ('GET', r'^/maestro/api/topic/list$', 'topic_list'),
+        ('POST', r'^/maestro/api/user/login$', 'login'),
+        ('GET', r'^/(?P<course>[^/]+)/lecture/preview$', 'lecture_index'),
+        ('GET', r'^/(?P<course>[^/]+)-001/lecture/index$', 'lecture_index'),
+        ('GET', r'^/(?P<course>[^/]+)/lecture/preview_view$', 'video_page'),
+        ('GET', r'^/(?P<course>[^/]+)-001/auth/auth_redirector$',
+         'auth_redirector'),
+        ('GET', r'^/videos/(?P<course>[^/]+)/(?P<lecture>\d+)\.mp4$',
+         'video'),
+        ('GET', r'^/(?P<course>[^/]+)-001/lecture/download\.mp4$', 'video'),
+        )
+
+    def do_GET(self):
+        self.route('GET')
+
+    def do_HEAD(self):
+        self.route('HEAD')
+
+    def do_POST(self):
+        self.route('POST')
+
+    def route(self, method):
+        opts = self.server.opts
+        url = urlparse.urlparse(self.path)
+        # The scripts add paths to home_links, which end in a /
+        path = re.sub('/+', '/', url.path)
+        self.query = dict(urlparse.parse_qsl(url.query))
+        self.form = {}
+        length = int(self.headers.get('Content-Length') or 0)
+        if length > 0:
+            self.form = dict(urlparse.parse_qsl(self.rfile.read(length)))
+        if opts.latency > 0:
+            time.sleep(opts.latency)
+        if self.server.should_fail():
+            self.respond(503, 'Try again later\n')
+            return
+        for (route_method, pattern, name) in self.ROUTES:
+            match = re.match(pattern, path)
+            if match is None:
+                continue
+            if route_method == method or (route_method, method) == ('GET',
+                                                                    'HEAD'):
+                getattr(self, name)(**match.groupdict())
+                return
+            self.respond(405, 'Method not allowed\n')
+            return
+        self.respond(404, 'Not found\n')
+
+    def respond(self, status, body, content_type='text/html',
+                headers=()):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for (name, value) in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.send_body([body])
+
+    def send_body(self, chunks):
+        """
+        Write out the body, a string at a time, no faster than
+        --bandwidth allows.
+        """
+        bandwidth = self.server.opts.bandwidth
+        start = time.time()
+        sent = 0
+        for chunk in chunks:
+            for ii in range(0, len(chunk), CHUNK_SIZE):
+                piece = chunk[ii:ii + CHUNK_SIZE]
+                self.wfile.write(piece)
+                sent += len(piece)
+                if bandwidth > 0:
+                    wait = float(sent) / bandwidth - (time.time() - start)
+                    if wait > 0:
+                        time.sleep(wait)
+
+    def log_message(self, format, *args):
+        pass
+
+    def course_number(self, course):
+        """
+        The index of a course (stub001 -> 0), or None if there is no
+        such course.
+        """
+        match = re.match(r'^stub(\d+)$', course)
+        if match is None:
+            return None
+        number = int(match.group(1)) - 1
+        if not 0 <= number < self.server.opts.courses:
+            return None
+        return number
+
+    # ----------------------------------------------------------------
+    # Pages
+
+    def topic_list(self):
+        etag = self.server.catalog_etag
+        if self.headers.get('If-None-Match') == etag:
+            self.respond(304, '', headers=[('ETag', etag)])
+            return
+        self.respond(200, self.server.catalog, 'application/json',
+                     [('ETag', etag)])
+
+    def lecture_index(self, course):
+        if self.course_number(course) is None:
+            self.respond(404, 'No such course\n')
+            return
+        token = hashlib.md5('%s %s' % (course, time.time())).hexdigest()
+        self.respond(200, lecture_index_page(self.server.base_url(), course,
+                                             self.server.opts),
+                     headers=[('Set-Cookie', 'csrf_token=%s; Path=/' % token)])
+
+    def video_page(self, course):
+        if self.course_number(course) is None:
+            self.respond(404, 'No such course\n')
+            return
+        lecture = self.query.get('lecture_id', '')
+        self.respond(200, video_page(self.server.base_url(), course, lecture))
+
+    def login(self):
+        if (not self.headers.get('X-CSRFToken')
+            or not self.form.get('email_address')
+            or not self.form.get('password')):
+            self.respond(401, '{"error": "login failed"}\n',
+                         'application/json')
+            return
+        self.respond(200, '{}\n', 'application/json',
+                     [('Set-Cookie', 'maestro_login=%s; Path=/'
+                       % hashlib.md5(self.form['email_address']).hexdigest())])
+
+    def auth_redirector(self, course):
+        session = hashlib.md5('%s %s' % (course, time.time())).hexdigest()
+        visiting = self.query.get('visiting') or (
+            '%s/%s-001/lecture/index' % (self.server.base_url(), course))
+        self.respond(302, '', headers=[
+            ('Location', visiting),
+            ('Set-Cookie', 'session=%s; Path=/' % session)])
+
+    def video(self, course, lecture=None):
+        """
+        A video of --video_size junk bytes.  Answers a single range
+        (bytes=start-end) with just that part.
+        """
+        size = self.server.opts.video_size
+        (start, end) = (0, size - 1)
+        status = 200
+        headers = [('Accept-Ranges', 'bytes')]
+        match = re.match(r'^bytes=(\d*)-(\d*)$',
+                         self.headers.get('Range') or '')
+        if match is not None and match.group(1) + match.group(2) != '':
+            if match.group(1) == '':
+                start = max(size - int(match.group(2)), 0)
+            else:
+                start = int(match.group(1))
+                if match.group(2) != '':
+                    end = min(int(match.group(2)), size - 1)
+            if start > end:
+                self.respond(416, '', headers=[
+                    ('Content-Range', 'bytes */%d' % size)])
+                return
+            status = 206
+            headers.append(('Content-Range',
+                            'bytes %d-%d/%d' % (start, end, size)))
+        self.send_response(status)
+        self.send_header('Content-Type', 'video/mp4')
+        self.send_header('Content-Length', str(end - start + 1))
+        for (name, value) in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.send_body(video_bytes(start, end + 1))
+
+# --------------------------------------------------------------------
+# Made up content
+
+def topic_list(base_url, opts):
+    """
+    The list of all courses, in the format of coursera_rss.ALL_URL.
+    """
+    courses = []
+    for ii in range(opts.courses):
+        name = 'stub%03d' % (ii + 1)
+        courses.append({
+            'id': ii + 1,
+            'short_name': name,
+            'name': 'Stub Course %d' % (ii + 1),
+            'instructor': 'Instructor %d' % (ii % 7 + 1),
+            'short_description': 'A made up course, with %d weeks of %d '
+                                 'lectures.' % (opts.weeks, opts.lectures),
+            'large_icon': '%s/icons/%s.png' % (base_url, name),
+            'small_icon': '%s/icons/%s-small.png' % (base_url, name),
+            'photo': '%s/photos/%s.jpg' % (base_url, name),
+            'preview_link': '%s/%s/lecture/preview' % (base_url, name),
+            'university-ids': ['stub-university-%d' % (ii % 3)],
+            'category-ids': ['stub-category-%d' % (ii % 5)],
+            'language': 'en',
+            'visibility': 0,
+            'courses': [{
+                'id': 1000 + ii,
+                'name': '001',
+                'home_link': '%s/%s-001/' % (base_url, name),
+                'active': True,
+                'start_day': 1,
+                'start_month': 1 + ii % 12,
+                'start_year': 2013,
+                'duration_string': '%d weeks' % opts.weeks,
+                'status': 1,
+                }],
+            })
+    return courses
+
+def lecture_index_page(base_url, course, opts):
+    """
+    A lecture index page, laid out like Coursera's.
+    """
+    parts = [page_header(course, opts.padding / 2)]
+    for week in range(opts.weeks):
+        parts.append('<div class="course-item-list-header expanded">'
+                     '<h3><span class="icon-chevron-down"></span>&nbsp;'
+                     'Week %d: Topic %d</h3></div>'
+                     '<ul class="course-item-list-section-list">'
+                     % (week + 1, week + 1))
+        for lecture in range(opts.lectures):
+            lecture_id = week * opts.lectures + lecture + 1
+            title = 'Lecture %d.%d' % (week + 1, lecture + 1)
+            parts.append('''
+<li class="unviewed">
+<a class="lecture-link" data-lecture-id="{id}" data-modal=".course-modal-frame" data-modal-iframe="{base}/{course}/lecture/preview_view?lecture_id={id}" href="{base}/{course}/lecture/preview_view/{id}" rel="lecture-link">
+{title} ({minutes}:{seconds:02d})</a>
+<div class="course-lecture-item-resource">
+<a href="{base}/{course}-001/lecture/download.mp4?lecture_id={id}" title="Video (MP4)"><i class="icon-download-alt"></i></a>
+<a href="{base}/{course}-001/lecture/subtitles?q={id}_en&amp;format=txt" title="Subtitles (text)"><i class="icon-file"></i></a>
+</div>
+</li>'''.format(id=lecture_id, base=base_url, course=course, title=title,
+                minutes=5 + lecture_id % 15, seconds=lecture_id * 7 % 60))
+        parts.append('</ul>')
+    parts.append(page_footer(opts.padding / 2))
+    return ''.join(parts)
+
+def video_page(base_url, course, lecture):
+    """
+    The page in the iframe that pops up for a lecture.
+    """
+    return '''<!DOCTYPE html>
+<html>
+<head>
+<title>Lecture {lecture}</title>
+<link rel="stylesheet" href="{base}/static/player.css">
+<script src="{base}/static/player.js"></script>
+</head>
+<body>
+<div class="course-modal-frame">
+<video id="QL_video_element_first" width="100%" height="100%" controls>
+<source type="video/mp4" src="{base}/videos/{course}/{lecture}.mp4">
+<source type="video/webm" src="{base}/videos/{course}/{lecture}.webm">
+</video>
+</div>
+<script>var player = new QL.Player("QL_video_element_first");</script>
+</body>
+</html>
+'''.format(base=base_url, course=course, lecture=urllib.quote(lecture))
+
+def page_header(course, size):
+    """
+    The top of a page, with scripts and navigation making up about
+    size bytes.
+    """
+    parts = ['<!DOCTYPE html>\n<html>\n<head>\n<title>%s | Lectures</title>\n'
+             % course]
+    script = ('<script type="text/javascript">\n'
+              'window.coursera = window.coursera || {}; '
+              'coursera.config = {"course": "%s", "flags": [%s]};\n'
+              '</script>\n' % (course, ', '.join(['"flag"'] * 20)))
+    nav = ('<li class="course-navbar-item"><a href="/%s/wiki/view">'
+           'Course Wiki</a></li>\n' % course)
+    parts.append(script * max(1, size / 2 / len(script)))
+    parts.append('</head>\n<body>\n<div class="course-navbar-list"><ul>\n')
+    parts.append(nav * max(1, size / 2 / len(nav)))
+    parts.append('</ul></div>\n<div class="course-item-list">\n')
+    return ''.join(parts)
+
+def page_footer(size):
+    """
+    The bottom of a page, with about size bytes of footer.
+    """
+    link = ('<a class="coursera-footer-link" href="/about/terms">'
+            'Terms of Service</a> | \n')
+    return ('</div>\n<div class="coursera-footer">\n%s</div>\n</body>\n'
+            '</html>\n' % (link * max(1, size / len(link))))
+
+def video_bytes(start, end):
+    """
+    Bytes start to end (not including end) of a junk video, a piece at
+    a time.
+    """
+    position = start
+    while position < end:
+        offset = position % len(VIDEO_BLOCK)
+        piece = VIDEO_BLOCK[offset:offset + min(end - position, CHUNK_SIZE)]
+        yield piece
+        position += len(piece)
+
+# --------------------------------------------------------------------
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+"""
+Caches for pages rendered by the podcast app.
+
+Rendered pages are kept in memcache when we're running on App Engine.
+Anywhere else (scripts, tests) they're kept in a LocalCache in this
+process instead, which evicts the least recently used page once it's
+full, the way memcache does.
+"""
+
+from   collections import OrderedDict
+import threading
+import time
+
+try:
+    from google.appengine.api import memcache
+except ImportError:
+    memcache = None
+
+# How many pages a LocalCache holds
+LOCAL_SIZE = 200
+# After a page is invalidated, how many seconds a render that started
+# before the invalidation is kept from re-adding the old page.
+LOCK_SECONDS = 10
+
+class LocalCache(object):
+    """
+    An in-process stand-in for the parts of memcache that we use.
+    """
+    def __init__(self, size=LOCAL_SIZE):
+        self.size   = size
+        self.values = OrderedDict()
+        # key -> time until which add() is refused (see delete)
+        self.locked = {}
+        self.lock   = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.values:
+                return None
+            value = self.values.pop(key)
+            self.values[key] = value
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self._store(key, value)
+        return True
+
+    def add(self, key, value):
+        """
+        Store value only if there is nothing under key, and key isn't
+        locked by a recent delete.
+        """
+        with self.lock:
+            if key in self.values or self.locked.get(key, 0) > time.time():
+                return False
+            self._store(key, value)
+        return True
+
+    def incr(self, key, delta=1, initial_value=None):
+        """
+        Add delta to the number stored under key, which starts at
+        initial_value if there's nothing there.  Returns the new number.
+        """
+        with self.lock:
+            value = self.values.get(key)
+            if value is None:
+                if initial_value is None:
+                    return None
+                value = initial_value
+            self._store(key, value + delta)
+            return value + delta
+
+    def delete(self, key, seconds=0):
+        """
+        Remove key.  Like memcache, if seconds is given, add() won't
+        store anything under key for that many seconds.
+        """
+        with self.lock:
+            self.values.pop(key, None)
+            if seconds > 0:
+                self.locked[key] = time.time() + seconds
+        return True
+
+    def _store(self, key, value):
+        self.values.pop(key, None)
+        self.values[key] = value
+        while len(self.values) > self.size:
+            self.values.popitem(last=False)
+        self.locked.pop(key, None)
+
+class FeedCache(object):
+    """
+    Rendered RSS feeds (or anything else made from a course), by
+    course name.
+
+    Each feed is stored with the version of the course it was rendered
+    from (its last_updated), and is only returned for that version.
+    Whatever changes a course must call invalidate after saving it.
+    """
+    def __init__(self, client=None, prefix='feed:'):
+        if client is None:
+            client = memcache if memcache is not None else LocalCache()
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, name, version):
+        """
+        Return the feed for the named course if we have it for this
+        version of the course, or None.
+        """
+        cached = self.client.get(self.prefix + name)
+        if cached is None:
+            return None
+        if cached[0] != version:
+            # Rendered from an older version, so make room for this one
+            self.client.delete(self.prefix + name)
+            return None
+        return cached[1]
+
+    def add(self, name, version, body):
+        """
+        Save the feed rendered for this version of the course.
+        """
+        try:
+            return self.client.add(self.prefix + name, (version, body))
+        except ValueError:
+            # Too big for memcache
+            return False
+
+    def invalidate(self, name):
+        """
+        Forget the feed for the named course.  Renders that were
+        already under way can't add their (old) feed back for a few
+        seconds.
+        """
+        self.client.delete(self.prefix + name, seconds=LOCK_SECONDS)
+
+class PageCache(object):
+    """
+    Rendered pages which all go out of date at once, like the pages of
+    the course listing.
+
+    Pages are stored under a generation number, and invalidate moves
+    on to a new generation, so pages from older generations are never
+    returned again (and eventually get evicted).  Read the generation
+    before rendering a page, and store the page under that generation,
+    so that a page rendered from data that changed meanwhile is never
+    found.
+    """
+    def __init__(self, client=None, prefix='page:'):
+        if client is None:
+            client = memcache if memcache is not None else LocalCache()
+        self.client = client
+        self.prefix = prefix
+
+    def generation(self):
+        generation = self.client.get(self.prefix + 'generation')
+        if generation is None:
+            # Start from the time, so that if the generation gets
+            # evicted, we don't go back to one we've already used.
+            generation = int(time.time() * 1000)
+            self.client.add(self.prefix + 'generation', generation)
+        return generation
+
+    def get(self, page, generation):
+        return self.client.get(self._key(page, generation))
+
+    def set(self, page, generation, body):
+        try:
+            return self.client.set(self._key(page, generation), body)
+        except ValueError:
+            # Too big for memcache
+            return False
+
+    def invalidate(self):
+        self.client.incr(self.prefix + 'generation',
+                         initial_value=int(time.time() * 1000))
+
+    def _key(self, page, generation):
+        return '%s%d:%s' % (self.prefix, generation, page)
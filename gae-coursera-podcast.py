@@ -4,19 +4,80 @@ A Google App Engine App that makes podcasts of Coursera lectures
 
 # We would ideally use requests and mechanize, but I want this to be
 # usable on Google App Engine, so I'm sticking to the older tech.
-import coursera_rss
+import bisect
+import calendar
 from   datetime import datetime, timedelta, date
-import jinja2
-import os
+from   email.utils import formatdate, mktime_tz, parsedate_tz
+import feedcache
+import hashlib
+import instrument
+import json
+import tasks
+import templates
+import time
+import urllib
+import uuid
 import webapp2
 import logging
+import zlib
 
 from google.appengine.ext import db
 from google.appengine.api import users as gusers
 from google.appengine.api import mail
 
-jinja_environment = jinja2.Environment(
-    loader=jinja2.FileSystemLoader(os.path.dirname(__file__)))
+jinja_environment = templates.make_environment()
+
+# The same as TIME_FORMAT.  It's repeated here so that
+# serving feeds doesn't need coursera_rss (see scraper).
+TIME_FORMAT = "%a, %d %b %Y %H:%M:%S -0500"
+
+# A refresh of the whole course list is split into this many shards,
+# each of which works in batches of REFRESH_BATCH courses and for at
+# most REFRESH_SECONDS before handing over to a new task.
+REFRESH_SHARDS = 8
+REFRESH_BATCH = 50
+REFRESH_SECONDS = 60
+# How many refreshes the refresh status page shows
+REFRESH_RUNS_SHOWN = 5
+
+# Rendered course.xml for each course, see CoursePage, and rendered
+# pages of the course listing, see HomePage.  (Both used to hold each
+# page in several encodings, under other prefixes.)
+FEED_CACHE = feedcache.FeedCache(prefix='feed-body:')
+HOME_CACHE = feedcache.PageCache(prefix='home-body:')
+# How many courses to list on each page of the home page
+HOME_PAGE_SIZE = 50
+# Version of the format of Course.lecture_blob, see pack_lectures
+LECTURE_FORMAT = 3
+# How many bytes of a lecture_blob to decompress at a time
+UNPACK_CHUNK = 4096
+# How many formatted dates format_pub_date remembers
+PUB_DATE_CACHE_SIZE = 4096
+# Feeds are sent out as they're rendered, STREAM_BUFFER template pieces
+# at a time, and cached unless they come to more than FEED_CACHE_LIMIT
+# bytes, which would be too much for memcache.
+STREAM_BUFFER = 100
+FEED_CACHE_LIMIT = 900 * 1024
+# An update job that hasn't finished in this long is taken to have died
+# (a task has at most 10 minutes).
+UPDATE_JOB_SECONDS = 15 * 60
+
+# --------------------------------------------------------------------
+# Scraping
+
+def scraper():
+    """
+    Returns the coursera_rss module.  It brings in urllib2, cookielib
+    and (when it parses a page) BeautifulSoup, none of which are
+    needed to serve feeds or the home page.  So it's only imported
+    the first time we actually read from Coursera, rather than when
+    a new instance starts up.
+    """
+    import coursera_rss
+    coursera_rss.TIMER = instrument
+    if coursera_rss.SIZE_CACHE is None:
+        coursera_rss.SIZE_CACHE = coursera_rss.SizeCache(VideoSizeStore())
+    return coursera_rss
 
 # --------------------------------------------------------------------
 # Data Models
@@ -34,6 +95,16 @@ class Course(db.Model):
     preview_url = db.StringProperty()
     # This is the last time we created an rss file for this course
     last_updated = db.DateTimeProperty()
+    # Fingerprint of the course list entry this was saved from
+    catalog_hash = db.StringProperty()
+    # The last time the course list entry changed, see feed_modified
+    catalog_changed = db.DateTimeProperty()
+    # A copy of the course's lectures (see pack_lectures), so that the
+    # feed can be made without querying the Lecture entities.
+    lecture_blob   = db.BlobProperty()
+    lecture_format = db.IntegerProperty()
+    # Fingerprint of all the lectures last saved, see lectures_hash
+    lectures_hash  = db.StringProperty()
 
     @classmethod
     def make_key(cls, name):
@@ -42,16 +113,41 @@ class Course(db.Model):
         """
         return db.Key.from_path('Course', name)
 
+    def feed_version(self):
+        """
+        Identifies the version of the course (and its lectures) that a
+        feed was rendered from.  Lectures are only ever changed along
+        with last_updated, so this just hashes that and the fields of
+        the course that appear in the feed.
+        """
+        fields = (self.last_updated, self.full_name, self.instructor,
+                  self.url, self.icon_url, self.description)
+        return hashlib.md5(repr(fields)).hexdigest()
+
+    def feed_modified(self):
+        """
+        When the feed last changed, which is when the lectures or the
+        course list entry (title, description, ...) last did.  None if
+        we don't know.
+        """
+        times = [when for when in (self.last_updated, self.catalog_changed)
+                 if when is not None]
+        return max(times) if times else None
+
     def preview_text(self):
         if self.preview_url is None or self.preview_url == '':
             return ""
         return "Preview"
 
     def pubDate(self):
-        return datetime.now().strftime(coursera_rss.TIME_FORMAT)
+        """
+        The feed changes when the course is updated, so that's when
+        it was published (and built).
+        """
+        return format_pub_date(self.last_updated or EPOCH)
 
     def lastBuildDate(self):
-        return datetime.now().strftime(coursera_rss.TIME_FORMAT)
+        return format_pub_date(self.last_updated or EPOCH)
 
 class Lecture(db.Model):
     """
@@ -62,28 +158,191 @@ class Lecture(db.Model):
     size     = db.StringProperty()
     url      = db.StringProperty(required=True)
     description = db.StringProperty()
+    # See lecture_pub_date
+    published = db.DateTimeProperty()
+    # Position of the lecture on the course's lecture page
+    order    = db.IntegerProperty()
+    # Fingerprint of the fields above, see lecture_hash
+    fingerprint = db.StringProperty()
 
     @classmethod
-    def make_key(cls, course_name, index):
+    def make_key(cls, course_name, lecture_id):
         """
-        Construct a Lecture key from a course and an index
+        Construct a Lecture key from a course and a lecture id (see
+        lecture_key_names)
         """
-        return db.Key.from_path('Course', course_name, 'Lecture', index)
+        return db.Key.from_path('Course', course_name, 'Lecture', lecture_id)
 
-    def pubDate(self):
+    def position(self):
+        """
+        Where the lecture goes in the feed.  Lectures saved before they
+        had an order were keyed by their position.
         """
-        The pub date is just a bogus date to make the lecture appear
-        in the same order as on the screen.
+        if self.order is not None:
+            return self.order
+        return int(self.key().name())
 
-        Note that some courses list the newest week first and some
-        list the newest week last, and we'll do whatever order it is
-        on the screen, so the newest lecture might not appear as the
-        newest available podcast.
+    def pubDate(self):
+        return format_pub_date(self.published)
+
+class LectureRecord(object):
+    """
+    A lecture unpacked from Course.lecture_blob.  It has the same
+    fields as a Lecture, so the feed template can use either.
+    """
+    def __init__(self, name, duration, size, url, description, published):
+        self.name        = name
+        self.duration    = duration
+        self.size        = size
+        self.url         = url
+        self.description = description
+        self.published   = published
+
+    def pubDate(self):
+        return format_pub_date(self.published)
+
+EPOCH = datetime(1970, 1, 1)
+
+def lecture_pub_date(updated, index):
+    """
+    The pub date of a lecture is just a bogus date to make the
+    lectures appear in the same order as on the screen: a day apart,
+    starting from the beginning of the year the course was updated.
+    It's worked out once, when the lecture is first saved, and a
+    lecture keeps its date from one update to the next unless it moves
+    (see place_lectures).
+
+    Note that some courses list the newest week first and some
+    list the newest week last, and we'll do whatever order it is
+    on the screen, so the newest lecture might not appear as the
+    newest available podcast.
+    """
+    return datetime(updated.year, 1, 1) + timedelta(days=index)
+
+_pub_dates = {}
+
+def format_pub_date(when):
+    """
+    Format a datetime for a feed.  Every render of a feed formats the
+    same dates again, so they're remembered.
+    """
+    formatted = _pub_dates.get(when)
+    if formatted is None:
+        if len(_pub_dates) >= PUB_DATE_CACHE_SIZE:
+            _pub_dates.clear()
+        formatted = when.strftime(TIME_FORMAT)
+        _pub_dates[when] = formatted
+    return formatted
+
+class UpdateJob(db.Model):
+    """
+    The latest job to update the lectures of a course, keyed by the
+    course's short_name (see job_key).
+
+    status is queued, running, done, failed, notfound (no such course
+    or no lectures) or needs_login (no preview, so we need a username
+    and password).
+    """
+    status    = db.StringProperty()
+    message   = db.StringProperty()
+    requested = db.DateTimeProperty()
+    started   = db.DateTimeProperty()
+    finished  = db.DateTimeProperty()
+
+    @classmethod
+    def make_key(cls, name):
+        return db.Key.from_path('UpdateJob', name)
+
+    def in_flight(self, now):
+        """
+        Whether the job is still queued or running.  A job that hasn't
+        finished after UPDATE_JOB_SECONDS is taken to have died.
         """
-        start = datetime.strptime(datetime.now().strftime("%Y0101 %H:%M:%S"),
-                                  '%Y%m%d %H:%M:%S')
-        pubdate = start + timedelta(days=int(self.key().name()))
-        return pubdate.strftime(coursera_rss.TIME_FORMAT)
+        return (self.status in ('queued', 'running')
+                and now - self.requested < timedelta(seconds=UPDATE_JOB_SECONDS))
+
+    def as_dict(self):
+        return {'name': self.key().name(),
+                'status': self.status,
+                'message': self.message,
+                'requested': str(self.requested),
+                'started': str(self.started),
+                'finished': str(self.finished)}
+
+class RefreshRun(db.Model):
+    """
+    A refresh of every course in the course list.  The work is split
+    between RefreshShard children, which run as separate tasks.
+    """
+    started = db.DateTimeProperty()
+    shards  = db.IntegerProperty()
+
+    @classmethod
+    def make_key(cls, run_id):
+        return db.Key.from_path('RefreshRun', run_id)
+
+class RefreshShard(db.Model):
+    """
+    One shard of a RefreshRun.  A shard goes through its courses in
+    order of short_name, and cursor is the last one done, so a shard
+    that runs out of time (or whose task fails) carries on from there.
+    """
+    shards    = db.IntegerProperty()
+    cursor    = db.StringProperty()
+    total     = db.IntegerProperty(default=0)
+    done      = db.IntegerProperty(default=0)
+    written   = db.IntegerProperty(default=0)
+    unchanged = db.IntegerProperty(default=0)
+    # How many tasks this shard has handed over to, for naming the next
+    tasks     = db.IntegerProperty(default=0)
+    updated   = db.DateTimeProperty()
+    finished  = db.DateTimeProperty()
+
+    @classmethod
+    def make_key(cls, run_id, index):
+        return db.Key.from_path('RefreshRun', run_id,
+                                'RefreshShard', str(index))
+
+class VideoSize(db.Model):
+    """
+    The size of a lecture video, keyed by a hash of its url, so that
+    updating a course doesn't have to ask for it again (see
+    coursera_rss.SizeCache).  size is None for a video that couldn't
+    be found.
+    """
+    url     = db.TextProperty()
+    size    = db.StringProperty(indexed=False)
+    checked = db.DateTimeProperty(indexed=False)
+
+    @classmethod
+    def make_key(cls, url):
+        return db.Key.from_path('VideoSize',
+                                hashlib.md5(url.encode('utf-8')).hexdigest())
+
+class VideoSizeStore(object):
+    """
+    Keeps the entries of a coursera_rss.SizeCache in VideoSize entities.
+    A course's videos are loaded with one batch get, rather than a get
+    for each video.
+    """
+    def load(self, urls):
+        entries = {}
+        for start in range(0, len(urls), BATCH_SIZE):
+            batch = urls[start:start + BATCH_SIZE]
+            videos = db.get([VideoSize.make_key(url) for url in batch])
+            for (url, video) in zip(batch, videos):
+                if video is None or video.url != url:
+                    continue
+                checked = calendar.timegm(video.checked.utctimetuple())
+                entries[url] = (video.size, checked)
+        return entries
+
+    def save(self, entries):
+        videos = [VideoSize(key=VideoSize.make_key(url), url=url, size=size,
+                            checked=datetime.utcfromtimestamp(checked))
+                  for (url, (size, checked)) in entries.items()]
+        for start in range(0, len(videos), BATCH_SIZE):
+            db.put(videos[start:start + BATCH_SIZE])
 
 # --------------------------------------------------------------------
 # Pages
@@ -92,18 +351,69 @@ class HomePage(webapp2.RequestHandler):
     """
     Shows a listing of all courses, including the last time each
     course was updated, and a link to update the course.
+
+    The listing is split into pages of HOME_PAGE_SIZE courses, and can
+    be limited to courses whose names start with a prefix.  Only the
+    fields shown are read from the datastore (not the descriptions),
+    and rendered pages are cached until a course changes.
     """
     def get(self):
-        courses = Course.all()
-        template = jinja_environment.get_template('home.html')
-        self.response.out.write(template.render({
-            'courses': courses
-            }))
+        prefix = self.request.get('prefix')
+        cursor = self.request.get('cursor')
+        page_name = urllib.urlencode({'prefix': prefix.encode('utf-8'),
+                                      'cursor': cursor})
+        generation = HOME_CACHE.generation()
+        page = HOME_CACHE.get(page_name, generation)
+        if page is None:
+            query = course_listing(prefix)
+            if cursor != '':
+                try:
+                    query.with_cursor(cursor)
+                except (db.BadValueError, db.BadRequestError):
+                    self.abort(400)
+            courses = query.fetch(HOME_PAGE_SIZE)
+            next_page = None
+            if len(courses) == HOME_PAGE_SIZE:
+                next_page = '/home?' + urllib.urlencode({
+                    'prefix': prefix.encode('utf-8'),
+                    'cursor': query.cursor()})
+            with instrument.phase('render'):
+                template = jinja_environment.get_template('home.html')
+                page = template.render({
+                    'courses': courses,
+                    'prefix': prefix,
+                    'next_page': next_page,
+                    }).encode('utf-8')
+            HOME_CACHE.set(page_name, generation, page)
+        self.response.out.write(page)
+
+def course_listing(prefix=''):
+    """
+    Returns a query for the courses whose names start with prefix, in
+    order of name, which only reads the fields shown on the home page.
+    """
+    query = db.Query(Course, projection=('full_name', 'last_updated',
+                                         'preview_url', 'url'))
+    if prefix != '':
+        query.filter('__key__ >=', Course.make_key(prefix))
+        query.filter('__key__ <', Course.make_key(prefix + u'\ufffd'))
+    return query.order('__key__')
 
 class CoursePage(webapp2.RequestHandler):
     """
     Takes a course name and shows the RSS feed of that course's
     lectures.
+
+    The feed only changes when the course is updated, so the rendered
+    feed is cached (in FEED_CACHE) until then.  The feed also has an
+    ETag and Last-Modified, so that podcast clients which already have
+    the current feed get a 304 without us reading any lectures.
+
+    A feed that isn't cached is sent out as it's rendered, from
+    lectures unpacked one at a time, so only a feed small enough to
+    cache is ever held in memory all at once.  Compressing it is left
+    to App Engine, which gzips responses for clients that accept that
+    (and drops any Content-Encoding the app sets itself).
     """
     def get(self):
         course_name = self.request.get('name')
@@ -115,131 +425,806 @@ class CoursePage(webapp2.RequestHandler):
             self.response.out.write(template.render({
                 'name': course_name}))
         else:
-            lectures = Lecture.all().ancestor(course)
-            lectures = sorted(lectures, key=lambda l: int(l.key().name()))
-            template = jinja_environment.get_template('course.xml')
-            self.response.out.write(template.render({
+            version = course.feed_version()
+            etag = '"%s"' % version
+            self.response.headers['ETag'] = etag
+            modified = course.feed_modified()
+            if modified is not None:
+                self.response.headers['Last-Modified'] = http_date(modified)
+            if not_modified(self.request, etag, modified):
+                self.response.set_status(304)
+                return
+            feed = FEED_CACHE.get(course_name, version)
+            if feed is not None:
+                self.response.out.write(feed)
+                return
+            with instrument.phase('render'):
+                template = jinja_environment.get_template('course.xml')
+            context = {
                 'course': course,
-                'lectures': lectures
-                }))
+                'lectures': course_lectures(course)
+                }
+            self.stream(template.stream(context),
+                        lambda feed: FEED_CACHE.add(course_name, version,
+                                                    feed))
+
+    def stream(self, template_stream, store):
+        """
+        Send the feed as the template renders it.  If it comes to no
+        more than FEED_CACHE_LIMIT bytes, store is called with the
+        whole feed once it has been sent.
+        """
+        template_stream.enable_buffering(STREAM_BUFFER)
+        chunks = (chunk.encode('utf-8') for chunk in
+                  instrument.timed_iter('render', template_stream))
+        self.response.app_iter = keep_chunks(chunks, store,
+                                             FEED_CACHE_LIMIT)
 
 class UpdatePage(webapp2.RequestHandler):
     """
-    Page for updating data.  If no course is given, we update the
-    course listings.  If a course is given, then we update the
-    lectures for that course.  If there is no preview for that course,
-    then we need to provide a username and password.  The username and
-    password will not be saved.
+    Page for updating data.  If no course is given, we start updating
+    the course listings in the background (see start_refresh and
+    RefreshPage).  If a course is given, then we start a job to update
+    the lectures for that course (see request_update), and send the
+    user to UpdateStatusPage to follow it.
+
+    If there is no preview for that course, then we need to provide a
+    username and password.  The username and password will not be
+    saved, so a job with them runs here, in this request, rather than
+    on the task queue.
     """
     def get(self):
         name     = self.request.get('name')
         username = self.request.get('username')
         password = self.request.get('password')
         if name is None or name == '':
-            all_courses = coursera_rss.all_courses()
-            for course in all_courses:
-                self.update_course(course)
-            self.redirect('/home')
+            start_refresh()
+            self.redirect('/refresh')
+            return
+        login = (username is not None and username != "" and
+                 password is not None and password != "")
+        (job, started) = request_update(name, queue=not login)
+        if started and login:
+            run_update_job(name, username, password)
+        self.redirect('/update_status?' + urllib.urlencode({
+            'name': name.encode('utf-8')}))
+
+class UpdateStatusPage(webapp2.RequestHandler):
+    """
+    Shows how the update job for a course is going.  With format=json,
+    this gives the UpdateJob as JSON, for polling.
+    """
+    def get(self):
+        name = self.request.get('name')
+        job = db.get(job_key(name)) if name != '' else None
+        if self.request.get('format') == 'json':
+            self.response.headers['Content-Type'] = 'application/json'
+            self.response.out.write(json.dumps(
+                job.as_dict() if job is not None else {'name': name}))
+        elif job is None or job.status == 'notfound':
+            template = jinja_environment.get_template('notfound.html')
+            self.response.out.write(template.render({
+                'name': name}))
+        elif job.status == 'needs_login':
+            template = jinja_environment.get_template('nopreview.html')
+            self.response.out.write(template.render({
+                'name': name}))
         else:
-            matches = coursera_rss.find_course(name)
-            if len(matches) == 0:
-                template = jinja_environment.get_template('notfound.html')
-                self.response.out.write(template.render({
-                    'name': name}))
-                return
-            (course, instance) = matches[0]
-            logging.info("Found course %s" % name)
-            course_obj = self.update_course(course)
-            if course_obj is None:
-                logging.info("Course %s has no instances" % name)
-                template = jinja_environment.get_template('notfound.html')
-                self.response.out.write(template.render({
-                    'name': name}))
-                return
-            lecture_data = coursera_rss.get_preview_lectures(course)
-            if lecture_data is None or len(lecture_data) == 0:
-                if (username is None or username == "" or
-                    password is None or password == ""):
-                    template = jinja_environment.get_template('nopreview.html')
-                    self.response.out.write(template.render({
-                        'name': name}))
-                    return
-                logging.info("No preview, reading current course info %s" % name)
-                lecture_data = coursera_rss.get_current_lectures(course,
-                                                                 username,
-                                                                 password,
-                                                                 instance)
-            if lecture_data is None or len(lecture_data) == 0:
-                logging.info("Found no lectures for %s" % name)
-                template = jinja_environment.get_template('notfound.html')
-                self.response.out.write(template.render({
-                    'name': name}))
-                return
-            logging.info("Got lectures")
-            for ii in range(len(lecture_data)):
-                (lecture_name, duration, size, mp4url, description, _) = lecture_data[ii]
-                lecture_obj = db.get(Lecture.make_key(name, str(ii)))
-                if lecture_obj is None:
-                    logging.info("Making lecture %d" % ii)
-                    lecture_obj = Lecture(
-                        key_name = str(ii),
-                        name = lecture_name,
-                        duration = duration,
-                        size = size,
-                        url = mp4url,
-                        description = description,
-                        parent = course_obj)
-                else:
-                    logging.info("Updating lecture %d" % ii)
-                    lecture_obj.name = lecture_name
-                    lecture_obj.duration = duration
-                    lecture_obj.size = size
-                    lecture_obj.url = mp4url
-                    lecture_obj.description = description
-                lecture_obj.put()
-            # Should remove lectures which are no longer valid?
-            course_obj.last_updated = datetime.now()
-            course_obj.put()
-            self.response.out.write("Updated %d lectures" % len(lecture_data))
+            self.response.out.write("%s: %s" % (job.status, job.message))
+
+class UpdateTask(webapp2.RequestHandler):
+    """
+    Task which runs the update job for a course.
+    """
+    def post(self):
+        run_update_job(self.request.get('name'))
+
+class RefreshPage(webapp2.RequestHandler):
+    """
+    Shows how far the latest refreshes of the course list have got.
+    """
+    def get(self):
+        runs = []
+        for run in RefreshRun.all().order('-started').fetch(REFRESH_RUNS_SHOWN):
+            shards = sorted(RefreshShard.all().ancestor(run),
+                            key=lambda shard: int(shard.key().name()))
+            runs.append((run, shards))
+        template = jinja_environment.get_template('refresh.html')
+        self.response.out.write(template.render({
+            'runs': runs
+            }))
+
+class TimingsPage(webapp2.RequestHandler):
+    """
+    Shows histograms of how long each phase of the requests to each
+    url has taken on this instance (see instrument.py), as JSON.  With
+    reset=1, starts them again.
+    """
+    def get(self):
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.out.write(json.dumps(instrument.STATS.snapshot(),
+                                           indent=1, sort_keys=True))
+        if self.request.get('reset') == '1':
+            instrument.STATS.reset()
+
+class RefreshTask(webapp2.RequestHandler):
+    """
+    Task which refreshes one shard of a RefreshRun.
+    """
+    def post(self):
+        run_refresh_shard(self.request.get('run'),
+                          int(self.request.get('shard')))
 
-    def update_course(self, course):
-        instance = coursera_rss.get_current_instance(course)
-        if instance is None:
+# -------------------------------------------------------------------
+# Packed lectures
+
+def pack_lectures(lectures):
+    """
+    Pack a list of [name, duration, size, url, description, published]
+    lectures into a compressed string, for Course.lecture_blob: a JSON
+    list for each lecture, one per line, so that they can be unpacked
+    one at a time.  The published datetime is packed as seconds since
+    the epoch.
+    """
+    rows = [list(lecture[:5]) + [calendar.timegm(lecture[5].timetuple())]
+            for lecture in lectures]
+    return db.Blob(zlib.compress('\n'.join(json.dumps(row,
+                                                      separators=(',', ':'))
+                                           for row in rows)))
+
+def unpack_lectures(blob):
+    """
+    Yields the LectureRecords packed by pack_lectures, decompressing
+    the blob a piece at a time as they're needed.
+    """
+    decompressor = zlib.decompressobj()
+    pending = ''
+    for start in range(0, len(blob), UNPACK_CHUNK):
+        pending += decompressor.decompress(blob[start:start + UNPACK_CHUNK])
+        lines = pending.split('\n')
+        pending = lines.pop()
+        for line in lines:
+            yield lecture_record(line)
+    pending += decompressor.flush()
+    if pending != '':
+        yield lecture_record(pending)
+
+def lecture_record(line):
+    fields = json.loads(line)
+    return LectureRecord(*(fields[:5]
+                           + [datetime.utcfromtimestamp(fields[5])]))
+
+def course_lectures(course):
+    """
+    Returns the course's lectures, in order.  They come from the
+    course's lecture_blob if it has one in the current format, and are
+    then unpacked as they're iterated over.  Otherwise they're all read
+    from its Lecture entities, and the blob is saved for next time.
+    """
+    if course.lecture_format == LECTURE_FORMAT and course.lecture_blob:
+        return unpack_lectures(course.lecture_blob)
+    lectures = Lecture.all().ancestor(course)
+    lectures = sorted(lectures, key=lambda l: l.position())
+    for (index, lecture) in enumerate(lectures):
+        if lecture.published is None:
+            # Saved before lectures had a pub date
+            lecture.published = lecture_pub_date(course.last_updated or EPOCH,
+                                                 index)
+    migrate_lectures(course.key(), course.last_updated, lectures)
+    return lectures
+
+def migrate_lectures(course_key, last_updated, lectures):
+    """
+    Save the given Lecture entities as the lecture_blob of the course,
+    unless the course has been updated since they were read.
+    """
+    blob = pack_lectures([[lecture.name, lecture.duration, lecture.size,
+                           lecture.url, lecture.description, lecture.published]
+                          for lecture in lectures])
+    def save():
+        course = db.get(course_key)
+        if (course is None or course.last_updated != last_updated
+            or course.lecture_format == LECTURE_FORMAT):
             return
+        course.lecture_blob   = blob
+        course.lecture_format = LECTURE_FORMAT
+        course.put()
+    db.run_in_transaction(save)
+
+# -------------------------------------------------------------------
+# Saving courses
+
+def catalog_hash(course, instance):
+    """
+    A fingerprint of the parts of a course list entry (and its current
+    instance) that we save on the Course entity.
+    """
+    fields = (course['name'], course['instructor'], course['large_icon'],
+              course['preview_link'], course['short_description'],
+              instance['home_link'], instance['start_month'],
+              instance['start_day'], instance['start_year'])
+    return hashlib.md5(repr(fields)).hexdigest()
+
+def apply_catalog(course, course_obj):
+    """
+    Copy a course list entry onto its Course entity, making a new one
+    if course_obj is None.  Only the fields that come from the course
+    list are set.  Returns the entity (None if the course has no
+    instances), and whether it changed and needs to be saved.
+    """
+    instance = scraper().get_current_instance(course)
+    if instance is None:
+        return (None, False)
+    fingerprint = catalog_hash(course, instance)
+    if course_obj is not None and course_obj.catalog_hash == fingerprint:
+        return (course_obj, False)
+    if course_obj is None:
+        course_obj = Course(key_name=course['short_name'])
+    course_obj.instructor   = course['instructor']
+    course_obj.full_name    = course['name']
+    course_obj.icon_url     = course['large_icon']
+    course_obj.url          = instance['home_link']
+    course_obj.preview_url  = course['preview_link']
+    course_obj.description  = course['short_description']
+    course_obj.start_date   = '%s/%s/%s' % (instance['start_month'],
+                                            instance['start_day'],
+                                            instance['start_year'])
+    course_obj.catalog_hash = fingerprint
+    course_obj.catalog_changed = datetime.now()
+    return (course_obj, True)
+
+def save_catalog(course):
+    """
+    Save a course list entry to its Course entity, if it has changed.
+    The entity is read again and saved in a transaction, so that the
+    lecture fields of an update that saved it meanwhile (see
+    update_lectures) aren't undone.  Returns the entity (None if the
+    course has no instances), and whether it was saved.
+    """
+    def save():
         course_obj = db.get(Course.make_key(course['short_name']))
-        if course_obj is None:
-            course_obj = Course(
-                key_name      = course['short_name']
-                ,full_name    = course['name']
-                ,instructor   = course['instructor']
-                ,start_date   = '%s/%s/%s' % (instance['start_month'],
-                                              instance['start_day'],
-                                              instance['start_year'])
-                ,url          = instance['home_link']
-                ,icon_url     = course['large_icon']
-                ,preview_url  = course['preview_link']
-                ,description  = course['short_description']
-                )
+        (course_obj, changed) = apply_catalog(course, course_obj)
+        if changed:
+            course_obj.put()
+        return (course_obj, changed)
+    (course_obj, changed) = db.run_in_transaction(save)
+    if changed:
+        FEED_CACHE.invalidate(course_obj.key().name())
+    return (course_obj, changed)
+
+def update_course(course):
+    """
+    Save a course list entry to its Course entity, if it has changed.
+    Returns the entity, or None if the course has no instances.
+    """
+    (course_obj, changed) = save_catalog(course)
+    if changed:
+        HOME_CACHE.invalidate()
+    return course_obj
+
+def refresh_courses(courses):
+    """
+    Save a batch of course list entries.  One batch get finds the
+    courses that changed, which are usually few, and only those are
+    saved, each with save_catalog.  Returns the number of courses
+    written and the number that were unchanged.
+    """
+    existing = db.get([Course.make_key(course['short_name'])
+                       for course in courses])
+    written = 0
+    for (course, course_obj) in zip(courses, existing):
+        (course_obj, needs_put) = apply_catalog(course, course_obj)
+        if needs_put and save_catalog(course)[1]:
+            written += 1
+    if written > 0:
+        HOME_CACHE.invalidate()
+    return (written, len(courses) - written)
+
+# -------------------------------------------------------------------
+# Updating a course's lectures
+
+def job_key(name):
+    """
+    The key of the UpdateJob for a course name, which can be the
+    course's short_name or the name of one of its instances.  Both
+    update the same Course, so the job is keyed by the short_name.  A
+    name that isn't in the course list is used as it is.
+    """
+    matches = scraper().find_course(name)
+    if len(matches) > 0:
+        name = matches[0][0]['short_name']
+    return UpdateJob.make_key(name)
+
+def request_update(name, queue=True):
+    """
+    Ask for the lectures of the named course to be updated.  If an
+    update of the course is already queued or running, this just
+    returns that job, so that however many times an update is asked
+    for, by whichever of its names, only one runs at a time.
+    Otherwise it starts a new job, and unless queue is False (meaning
+    the caller will run it), queues a task to run it.  The task is
+    queued in the same transaction as the job is saved, so there's
+    never a queued job without a task.
+
+    Returns the UpdateJob, and whether a new job was started.
+    """
+    key = job_key(name)
+    def claim():
+        now = datetime.now()
+        job = db.get(key)
+        if job is not None and job.in_flight(now):
+            return (job, False)
+        job = UpdateJob(key=key, status='queued', message='',
+                        requested=now)
+        job.put()
+        if queue:
+            tasks.add('/tasks/update', {'name': name.encode('utf-8')},
+                      transactional=True)
+        return (job, True)
+    (job, started) = tasks.run_in_transaction(claim)
+    if not started:
+        logging.info("Update of %s is already %s" % (name, job.status))
+    return (job, started)
+
+def run_update_job(name, username=None, password=None):
+    """
+    Run the update job for the named course, recording how it went
+    on its UpdateJob.
+    """
+    key = job_key(name)
+    job = db.get(key)
+    if job is None:
+        job = UpdateJob(key=key, requested=datetime.now())
+    job.status = 'running'
+    job.started = datetime.now()
+    job.put()
+    try:
+        (job.status, job.message) = update_lectures(name, username, password)
+    except Exception as e:
+        logging.exception("Update of %s failed" % name)
+        (job.status, job.message) = ('failed', repr(e)[:500])
+    job.finished = datetime.now()
+    job.put()
+    return job
+
+def update_lectures(name, username=None, password=None):
+    """
+    Read the lectures for the named course from Coursera, and save
+    them.  Returns a (status, message) pair for the UpdateJob.
+    """
+    matches = scraper().find_course(name)
+    if len(matches) == 0:
+        return ('notfound', "No course named %s" % name)
+    (course, instance) = matches[0]
+    logging.info("Found course %s" % name)
+    course_obj = update_course(course)
+    if course_obj is None:
+        logging.info("Course %s has no instances" % name)
+        return ('notfound', "Course %s has no instances" % name)
+    # Lectures whose video couldn't be read this time
+    failed = []
+    lecture_data = scraper().get_preview_lectures(course, failed=failed)
+    if (lecture_data is None or len(lecture_data) == 0) and len(failed) == 0:
+        if username is None or password is None:
+            return ('needs_login', "Course %s has no preview" % name)
+        logging.info("No preview, reading current course info %s" % name)
+        lecture_data = scraper().get_current_lectures(course,
+                                                      username,
+                                                      password,
+                                                      instance,
+                                                      failed=failed)
+    if (lecture_data is None or len(lecture_data) == 0) and len(failed) == 0:
+        logging.info("Found no lectures for %s" % name)
+        return ('notfound', "Found no lectures for %s" % name)
+    logging.info("Got lectures")
+    if len(failed) > 0:
+        # Keep what we have of those, and don't delete anything, since
+        # we can't tell what's really gone.
+        (lecture_data, kept) = keep_failed_lectures(course_obj,
+                                                    lecture_data or [],
+                                                    failed)
+        logging.warning("Couldn't read %d lectures of %s, kept %d saved ones"
+                        % (len(failed), name, kept))
+    updated = datetime.now()
+    fingerprint = lectures_hash(lecture_data)
+    unread = ", %d couldn't be read" % len(failed) if len(failed) > 0 else ''
+    if (course_obj.lectures_hash == fingerprint
+        and course_obj.lecture_format == LECTURE_FORMAT):
+        logging.info("Lectures of %s are unchanged" % name)
+        return ('done', "%d lectures, all unchanged%s"
+                % (len(lecture_data), unread))
+    (published, written, unchanged, deleted) = sync_lectures(
+        course_obj, lecture_data, updated, delete=len(failed) == 0)
+    logging.info("Wrote %d lectures, skipped %d unchanged, deleted %d"
+                 % (written, unchanged, deleted))
+    blob = pack_lectures([list(lecture[:5]) + [when]
+                          for (lecture, when) in zip(lecture_data, published)])
+    # With lectures missing, this isn't the whole course, so make sure
+    # the next update saves it again.
+    if len(failed) > 0:
+        fingerprint = None
+    def save():
+        # Only the lecture fields, on the course as it is now, so that
+        # a course list refresh saved since we read it isn't undone
+        course = db.get(course_obj.key())
+        course.lecture_blob   = blob
+        course.lecture_format = LECTURE_FORMAT
+        course.lectures_hash  = fingerprint
+        course.last_updated   = updated
+        course.put()
+    db.run_in_transaction(save)
+    FEED_CACHE.invalidate(course_obj.key().name())
+    HOME_CACHE.invalidate()
+    return ('done', "%d lectures: %d written, %d unchanged, %d deleted%s"
+            % (len(lecture_data), written, unchanged, deleted, unread))
+
+def keep_failed_lectures(course_obj, lecture_data, failed):
+    """
+    Put the saved copies of lectures that couldn't be read (the
+    (position, lecture) pairs from coursera_rss.get_lecture_info's
+    failed) back into lecture_data, where they belong.  Failed
+    lectures that were never saved, or that have no lecture id to
+    find them by, are left out.  Returns the lectures, and how many
+    were put back.
+    """
+    course_name = course_obj.key().name()
+    with_ids = [(position, lecture) for (position, lecture) in failed
+                if lecture[6]]
+    saved = db.get([Lecture.make_key(course_name, 'id:' + lecture[6])
+                    for (_, lecture) in with_ids])
+    lectures = list(lecture_data)
+    kept = 0
+    # From the end, so that the positions of earlier ones still hold
+    for ((position, lecture), lecture_obj) in reversed(zip(with_ids, saved)):
+        if lecture_obj is None:
+            continue
+        fields = [lecture_obj.name, lecture_obj.duration, lecture_obj.size,
+                  lecture_obj.url, lecture_obj.description]
+        # The same as get_lecture_info gives, so the fingerprint matches
+        fields = [field.encode('ascii', 'ignore') if field is not None
+                  else None for field in fields]
+        lectures.insert(position, fields + [lecture[5], lecture[6]])
+        kept += 1
+    return (lectures, kept)
+
+# -------------------------------------------------------------------
+# Refreshing the whole course list
+
+def start_refresh(shards=REFRESH_SHARDS):
+    """
+    Start refreshing every course in the course list, with a task for
+    each shard.  Returns the RefreshRun.
+    """
+    now = datetime.now()
+    # Runs started in the same second mustn't share a key (or task names)
+    run_id = '%s-%s' % (now.strftime('%Y%m%d-%H%M%S'), uuid.uuid4().hex[:8])
+    run = RefreshRun(key_name=run_id,
+                     started=now,
+                     shards=shards)
+    db.put([run] + [RefreshShard(key_name=str(ii), parent=run, shards=shards)
+                    for ii in range(shards)])
+    for ii in range(shards):
+        queue_refresh_shard(run.key().name(), ii, 0)
+    return run
+
+def queue_refresh_shard(run_id, index, count):
+    tasks.add('/tasks/refresh',
+              {'run': run_id, 'shard': index},
+              name='refresh-%s-%d-%d' % (run_id, index, count))
+
+def shard_courses(courses, shards, index):
+    """
+    Return the courses that belong to a shard, in order of short_name.
+    """
+    mine = [course for course in courses
+            if (zlib.crc32(course['short_name'].encode('utf-8'))
+                & 0xffffffff) % shards == index]
+    return sorted(mine, key=lambda course: course['short_name'])
+
+def run_refresh_shard(run_id, index):
+    """
+    Refresh a shard's courses, starting after its cursor, saving the
+    cursor after each batch.  If this runs out of time, it queues
+    another task to finish the shard.
+    """
+    shard = db.get(RefreshShard.make_key(run_id, index))
+    if shard is None or shard.finished is not None:
+        return
+    courses = shard_courses(scraper().all_courses(), shard.shards, index)
+    shard.total = len(courses)
+    todo = [course for course in courses
+            if shard.cursor is None or course['short_name'] > shard.cursor]
+    deadline = time.time() + REFRESH_SECONDS
+    while len(todo) > 0:
+        batch = todo[:REFRESH_BATCH]
+        todo = todo[REFRESH_BATCH:]
+        (written, unchanged) = refresh_courses(batch)
+        shard.cursor     = batch[-1]['short_name']
+        shard.done      += len(batch)
+        shard.written   += written
+        shard.unchanged += unchanged
+        shard.updated    = datetime.now()
+        shard.put()
+        if time.time() >= deadline:
+            break
+    if len(todo) > 0:
+        shard.tasks += 1
+        shard.put()
+        queue_refresh_shard(run_id, index, shard.tasks)
+    else:
+        shard.finished = datetime.now()
+        shard.put()
+        logging.info("Finished shard %d of refresh %s" % (index, run_id))
+
+# -------------------------------------------------------------------
+# Conditional requests
+
+def http_date(when):
+    """
+    Format a (UTC) datetime for an HTTP header.
+    """
+    return formatdate(calendar.timegm(when.utctimetuple()), usegmt=True)
+
+def not_modified(request, etag, last_modified):
+    """
+    Returns True if the request's If-None-Match or If-Modified-Since
+    header says that the client already has the version with the given
+    etag and last_modified datetime.
+    """
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        tags = [tag[2:] if tag.startswith('W/') else tag for tag in tags]
+        return etag in tags or '*' in tags
+    if_modified_since = request.headers.get('If-Modified-Since')
+    if if_modified_since is not None and last_modified is not None:
+        since = parsedate_tz(if_modified_since)
+        if since is not None:
+            return (mktime_tz(since) >=
+                    calendar.timegm(last_modified.utctimetuple()))
+    return False
+
+# -------------------------------------------------------------------
+# Streaming
+
+def keep_chunks(chunks, store, limit):
+    """
+    Yields the chunks, while also keeping them.  If they come to no
+    more than limit bytes, store is called with them all joined
+    together at the end.  Once they're bigger, nothing more is kept.
+    """
+    kept = []
+    size = 0
+    for chunk in chunks:
+        size += len(chunk)
+        if kept is not None and size > limit:
+            kept = None
+        if kept is not None:
+            kept.append(chunk)
+        if chunk:
+            yield chunk
+    if kept is not None:
+        store(''.join(kept))
+
+# -------------------------------------------------------------------
+# Saving lectures
+
+# Most entities to put or delete in one datastore call
+BATCH_SIZE = 500
+# How far apart the orders of newly numbered lectures are, leaving room
+# for lectures added later to go in between (see place_lectures)
+ORDER_GAP = 1024
+
+def lecture_key_names(lecture_data):
+    """
+    The key names of the Lecture entities for lecture_data.  A lecture
+    is keyed by its Coursera lecture id, so that it keeps its entity
+    when other lectures are added or moved.  A lecture without an id
+    is keyed by a hash of its video url instead, and if the same key
+    comes up twice, the second one gets its position added.
+    """
+    names = []
+    seen = set()
+    for (ii, lecture) in enumerate(lecture_data):
+        (_, _, _, mp4url, _, _, lecture_id) = lecture
+        if lecture_id:
+            name = 'id:' + lecture_id
+        else:
+            name = 'url:' + hashlib.md5(mp4url).hexdigest()
+        if name in seen:
+            name = '%s:%d' % (name, ii)
+        seen.add(name)
+        names.append(name)
+    return names
+
+def lecture_hash(lecture, order, published):
+    """
+    A fingerprint of the parts of a lecture (as returned by
+    coursera_rss.get_lecture_info) that we save on its Lecture entity.
+    """
+    (lecture_name, duration, size, mp4url, description, _, _) = lecture
+    # The datastore gives back orders as longs, whose repr differs
+    fields = (lecture_name, duration, size, mp4url, description,
+              int(order), published)
+    return hashlib.md5(repr(fields)).hexdigest()
+
+def lectures_hash(lecture_data):
+    """
+    A fingerprint of all of a course's lectures, which changes if any
+    lecture does, or if they're added, removed or moved.  The orders
+    and pub dates are left out, since place_lectures only changes them
+    when the lectures change.
+    """
+    digest = hashlib.md5()
+    for (key_name, lecture) in zip(lecture_key_names(lecture_data),
+                                   lecture_data):
+        digest.update('%s %r\n' % (key_name, tuple(lecture[:5])))
+    return digest.hexdigest()
+
+def place_lectures(existing, updated):
+    """
+    Choose the order and pub date of each lecture of a course, given
+    its existing Lecture entity (or None) for each, in the order
+    they're listed.
+
+    The longest run of existing lectures that are still in the same
+    order keep their order and pub date, so adding, removing or moving
+    a few lectures doesn't change the others.  The rest are spread out
+    in the gaps between them, ORDER_GAP and a day apart, or closer to
+    fit.  If there's no room in a gap, or there are no lectures to
+    keep, they're all numbered again, with lecture_pub_date(updated).
+
+    Returns a list of (order, published) pairs.
+    """
+    kept = kept_lectures(existing)
+    places = [None] * len(existing)
+    for index in kept:
+        places[index] = (existing[index].order, existing[index].published)
+    bounds = [-1] + kept + [len(existing)]
+    for (start, end) in zip(bounds, bounds[1:]):
+        count = end - start - 1
+        if count == 0:
+            continue
+        if start >= 0 and end < len(existing):
+            (low_order, low_date) = places[start]
+            (high_order, high_date) = places[end]
+            order_step = min(ORDER_GAP, (high_order - low_order) // (count + 1))
+            seconds = (high_date - low_date).total_seconds()
+            date_step = timedelta(seconds=min(24 * 60 * 60,
+                                              seconds // (count + 1)))
+            if order_step < 1 or date_step < timedelta(seconds=1):
+                places = None
+                break
+        elif start >= 0:
+            (low_order, low_date) = places[start]
+            (order_step, date_step) = (ORDER_GAP, timedelta(days=1))
+        elif end < len(existing):
+            (high_order, high_date) = places[end]
+            (order_step, date_step) = (ORDER_GAP, timedelta(days=1))
+            low_order = high_order - order_step * (count + 1)
+            low_date = high_date - date_step * (count + 1)
         else:
-            course_obj.instructor  = course['instructor']
-            course_obj.full_name   = course['name']
-            course_obj.icon_url    = course['large_icon']
-            course_obj.url         = instance['home_link']
-            course_obj.preview_url = course['preview_link']
-            course_obj.description = course['short_description']
-            course_obj.start_date  = '%s/%s/%s' % (instance['start_month'],
-                                                   instance['start_day'],
-                                                   instance['start_year'])
-        course_obj.put()
-        return course_obj
+            places = None
+            break
+        for ii in range(count):
+            places[start + 1 + ii] = (low_order + order_step * (ii + 1),
+                                      low_date + date_step * (ii + 1))
+    if places is not None:
+        return places
+    return [(index * ORDER_GAP, lecture_pub_date(updated, index))
+            for index in range(len(existing))]
+
+def kept_lectures(existing):
+    """
+    The indexes of the longest run of the existing Lecture entities
+    (some of which are None) whose orders and pub dates both still
+    increase, for place_lectures.
+    """
+    # Longest increasing run of orders, by patience sorting
+    tails = []
+    tail_orders = []
+    previous = {}
+    for (index, lecture_obj) in enumerate(existing):
+        if (lecture_obj is None or lecture_obj.order is None
+            or lecture_obj.published is None):
+            continue
+        pos = bisect.bisect_left(tail_orders, lecture_obj.order)
+        previous[index] = tails[pos - 1] if pos > 0 else None
+        if pos == len(tails):
+            tails.append(index)
+            tail_orders.append(lecture_obj.order)
+        else:
+            tails[pos] = index
+            tail_orders[pos] = lecture_obj.order
+    run = []
+    index = tails[-1] if tails else None
+    while index is not None:
+        run.append(index)
+        index = previous[index]
+    run.reverse()
+    # Drop any whose pub dates are out of step with their orders
+    kept = []
+    for index in run:
+        if (len(kept) == 0
+            or existing[index].published > existing[kept[-1]].published):
+            kept.append(index)
+    return kept
+
+def sync_lectures(course_obj, lecture_data, updated, delete=True):
+    """
+    Make the course's Lecture entities match lecture_data (as returned
+    by coursera_rss.get_lecture_info).  Lectures are keyed by
+    lecture_key_names, and get their order and pub date from
+    place_lectures.  Existing lectures are read with one batch get,
+    and only new ones, and ones whose fingerprint (see lecture_hash)
+    changed, are written, in one batch put.  Ones no longer in the
+    list are deleted, unless delete is False.
+
+    Returns the pub date of each lecture, and the number of lectures
+    written, unchanged and deleted.
+    """
+    course_name = course_obj.key().name()
+    keys = [Lecture.make_key(course_name, key_name)
+            for key_name in lecture_key_names(lecture_data)]
+    existing = db.get(keys)
+    places = place_lectures(existing, updated)
+    changed = []
+    for (key, lecture_obj, lecture, (order, when)) in zip(
+            keys, existing, lecture_data, places):
+        (lecture_name, duration, size, mp4url, description, _, _) = lecture
+        fingerprint = lecture_hash(lecture, order, when)
+        if lecture_obj is None:
+            lecture_obj = Lecture(
+                key_name = key.name(),
+                name = lecture_name,
+                duration = duration,
+                size = size,
+                url = mp4url,
+                description = description,
+                published = when,
+                order = order,
+                fingerprint = fingerprint,
+                parent = course_obj)
+        elif lecture_obj.fingerprint == fingerprint:
+            continue
+        else:
+            lecture_obj.name = lecture_name
+            lecture_obj.duration = duration
+            lecture_obj.size = size
+            lecture_obj.url = mp4url
+            lecture_obj.description = description
+            lecture_obj.published = when
+            lecture_obj.order = order
+            lecture_obj.fingerprint = fingerprint
+        changed.append(lecture_obj)
+
+    stale = []
+    if delete:
+        current = set(keys)
+        stale = [key for key in Lecture.all(keys_only=True).ancestor(course_obj)
+                 if key not in current]
+
+    for start in range(0, len(changed), BATCH_SIZE):
+        db.put(changed[start:start + BATCH_SIZE])
+    for start in range(0, len(stale), BATCH_SIZE):
+        db.delete(stale[start:start + BATCH_SIZE])
+    return ([when for (_, when) in places],
+            len(changed), len(keys) - len(changed), len(stale))
 
 # -------------------------------------------------------------------
 # webapp
 
-app = webapp2.WSGIApplication(
+instrument.install_api_hooks()
+
+app = instrument.TimingMiddleware(webapp2.WSGIApplication(
     [('/home',        HomePage)
      ,('/',           HomePage)
      ,('/course',     CoursePage)
      ,('/update',     UpdatePage)
+     ,('/update_status', UpdateStatusPage)
+     ,('/refresh',    RefreshPage)
+     ,('/tasks/refresh', RefreshTask)
+     ,('/tasks/update',  UpdateTask)
+     ,('/debug/timings', TimingsPage)
      ],
-    debug=True)
+    debug=True))
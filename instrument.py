@@ -0,0 +1,286 @@
+"""
+Timing where the podcast app's requests spend their time.
+
+TimingMiddleware wraps the app.  For each request, it adds up the
+time spent in each phase:
+
+ fetch      reading pages from Coursera (coursera_rss.ReadUrl)
+ parse      parsing them (BeautifulSoup, the course list)
+ datastore  datastore calls
+ memcache   memcache calls
+ render     rendering templates
+
+and sends them back in a Server-Timing header, along with the total,
+so they show up in the browser's developer tools.  They're also added
+to per-url histograms in STATS, which the app shows on a debug page.
+The histograms are per instance, and start again when it does.
+
+Code marks a phase with
+
+ with instrument.phase('parse'):
+     ...
+
+which does nothing outside of a request.  Datastore and memcache
+calls are timed by hooks on the App Engine API proxy (see
+install_api_hooks).  Phases of work done on another thread only count
+towards the request if the function run there was wrapped with bind.
+The headers are sent before a streamed response is rendered, so its
+Server-Timing only has what came before; the histograms have it all.
+"""
+
+from   contextlib import contextmanager
+import threading
+import time
+
+import webob
+
+try:
+    from google.appengine.api import apiproxy_stub_map
+except ImportError:
+    apiproxy_stub_map = None
+
+PHASES = ('fetch', 'parse', 'datastore', 'memcache', 'render')
+# Upper bounds, in milliseconds, of the histogram buckets.  Anything
+# slower goes in a last bucket.
+BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+# API proxy services timed by install_api_hooks, and their phases
+API_PHASES = {'datastore_v3': 'datastore',
+              'memcache': 'memcache'}
+
+_local = threading.local()
+
+# --------------------------------------------------------------------
+# Timing phases
+
+class RequestTimings(object):
+    """
+    The time spent in each phase of one request so far.
+    """
+    def __init__(self):
+        self.seconds = {}
+        self.calls   = {}
+        self.lock    = threading.Lock()
+
+    def add(self, name, seconds):
+        with self.lock:
+            self.seconds[name] = self.seconds.get(name, 0) + seconds
+            self.calls[name]   = self.calls.get(name, 0) + 1
+
+    def server_timing(self, total):
+        """
+        The value of a Server-Timing header for these timings.
+        """
+        metrics = ['%s;desc="%d calls";dur=%.1f' % (
+                       name, self.calls[name], self.seconds[name] * 1000)
+                   for name in PHASES if name in self.seconds]
+        metrics.append('total;dur=%.1f' % (total * 1000))
+        return ', '.join(metrics)
+
+def current():
+    """
+    The RequestTimings of the request being handled on this thread, or
+    None.
+    """
+    return getattr(_local, 'timings', None)
+
+@contextmanager
+def phase(name):
+    """
+    Count the time spent in the block towards the named phase of the
+    current request.
+    """
+    timings = current()
+    if timings is None:
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        timings.add(name, time.time() - start)
+
+def bind(func):
+    """
+    Wrap func so that the phases it times, on whatever thread it runs
+    on, count towards the current request.
+    """
+    timings = current()
+    if timings is None:
+        return func
+    def bound(*args, **kwargs):
+        previous = current()
+        _local.timings = timings
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.timings = previous
+    return bound
+
+def timed_iter(name, iterable):
+    """
+    Pass on the items of iterable, counting the time spent producing
+    each one towards the named phase.
+    """
+    items = iter(iterable)
+    while True:
+        with phase(name):
+            try:
+                item = next(items)
+            except StopIteration:
+                return
+        yield item
+
+# --------------------------------------------------------------------
+# Histograms
+
+class Histogram(object):
+    """
+    Counts of durations, in the buckets given by BUCKETS.
+    """
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total  = 0.0
+        self.count  = 0
+
+    def add(self, ms):
+        bucket = 0
+        while bucket < len(BUCKETS) and ms > BUCKETS[bucket]:
+            bucket += 1
+        self.counts[bucket] += 1
+        self.total += ms
+        self.count += 1
+
+    def as_dict(self):
+        labels = ['<=%d' % bound for bound in BUCKETS]
+        labels.append('>%d' % BUCKETS[-1])
+        return {'count': self.count,
+                'mean_ms': self.total / self.count if self.count else 0,
+                'buckets': dict((label, count)
+                                for (label, count) in zip(labels, self.counts)
+                                if count > 0)}
+
+class TimingStats(object):
+    """
+    A Histogram of each phase (and the total) of the requests to each
+    path.
+    """
+    def __init__(self):
+        self.histograms = {}
+        self.lock       = threading.Lock()
+
+    def add(self, path, timings, total):
+        with self.lock:
+            phases = self.histograms.setdefault(path, {})
+            with timings.lock:
+                measured = dict(timings.seconds)
+            measured['total'] = total
+            for (name, seconds) in measured.items():
+                phases.setdefault(name, Histogram()).add(seconds * 1000)
+
+    def snapshot(self):
+        """
+        The histograms, as a dict of path -> phase -> histogram dict.
+        """
+        with self.lock:
+            return dict((path, dict((name, histogram.as_dict())
+                                    for (name, histogram) in phases.items()))
+                        for (path, phases) in self.histograms.items())
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+
+STATS = TimingStats()
+
+# --------------------------------------------------------------------
+# The middleware
+
+class TimingMiddleware(object):
+    """
+    WSGI middleware which times each request to app (see the module
+    docstring), and adds what it measured to stats.
+    """
+    def __init__(self, app, stats=STATS):
+        self.app   = app
+        self.stats = stats
+
+    def __call__(self, environ, start_response):
+        timings = RequestTimings()
+        start = time.time()
+        path = environ.get('PATH_INFO', '')
+
+        def timed_start_response(status, headers, exc_info=None):
+            headers = list(headers) + [
+                ('Server-Timing', timings.server_timing(time.time() - start))]
+            return start_response(status, headers, exc_info)
+
+        # A request can be made from inside another one (see
+        # tasks.LocalTaskQueue), so put back whatever we found.
+        previous = current()
+        _local.timings = timings
+        try:
+            body = self.app(environ, timed_start_response)
+        except:
+            self.stats.add(path, timings, time.time() - start)
+            raise
+        finally:
+            _local.timings = previous
+        return self.iter_body(body, timings, start, path)
+
+    def iter_body(self, body, timings, start, path):
+        """
+        Pass on the response body, still timing phases while it's
+        produced, and record the timings once it's all been sent.
+        """
+        try:
+            chunks = iter(body)
+            while True:
+                previous = current()
+                _local.timings = timings
+                try:
+                    chunk = next(chunks)
+                except StopIteration:
+                    break
+                finally:
+                    _local.timings = previous
+                yield chunk
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+            self.stats.add(path, timings, time.time() - start)
+
+    def get_response(self, *args, **kwargs):
+        """
+        Like webapp2.WSGIApplication.get_response, for calling the app
+        (through the middleware) without a server.
+        """
+        return webob.Request.blank(*args, **kwargs).get_response(self)
+
+# --------------------------------------------------------------------
+# App Engine API calls
+
+def install_api_hooks():
+    """
+    Time calls to the App Engine services in API_PHASES, by hooking
+    into the API proxy.  Does nothing outside of App Engine.
+    """
+    if apiproxy_stub_map is None:
+        return
+    hooks = apiproxy_stub_map.apiproxy
+    hooks.GetPreCallHooks().Append('instrument', _before_api_call)
+    hooks.GetPostCallHooks().Append('instrument', _after_api_call)
+
+def _before_api_call(service, call, request, response):
+    if service in API_PHASES and current() is not None:
+        if not hasattr(_local, 'api_starts'):
+            _local.api_starts = {}
+        _local.api_starts[id(request)] = time.time()
+
+def _after_api_call(service, call, request, response, rpc=None, error=None):
+    starts = getattr(_local, 'api_starts', None)
+    if not starts or id(request) not in starts:
+        return
+    seconds = time.time() - starts.pop(id(request))
+    timings = current()
+    if timings is not None:
+        timings.add(API_PHASES[service], seconds)
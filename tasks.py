@@ -0,0 +1,120 @@
+"""
+Running work in the background.
+
+On App Engine (and the development server), tasks go on the default
+push queue, which POSTs each task's params to a url of the app.  Tests
+set QUEUE to a LocalTaskQueue instead, which POSTs the tasks straight
+to the app, in this process.
+
+A task added with transactional=True is only queued if the datastore
+transaction it's added in commits.  Run such transactions with
+run_in_transaction here rather than db.run_in_transaction, so that a
+LocalTaskQueue can do the same.
+"""
+
+from   collections import deque
+import logging
+import threading
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import db
+
+# If set, tasks go here instead of to the App Engine task queue
+QUEUE = None
+
+def add(url, params=None, name=None, transactional=False):
+    """
+    Queue a task which POSTs params to url.  If name is given and a
+    task with that name was already queued, the task isn't queued
+    again, and this returns False.  If transactional is True, the task
+    is only queued once the transaction this is called in (see
+    run_in_transaction) commits.  Transactional tasks can't be named.
+    """
+    if QUEUE is not None:
+        return QUEUE.add(url, params, name, transactional)
+    try:
+        taskqueue.add(url=url, params=params or {}, name=name,
+                      transactional=transactional)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        logging.info("Task %s already queued" % name)
+        return False
+    return True
+
+def run_in_transaction(func, *args, **kwargs):
+    """
+    Run func in a datastore transaction, like db.run_in_transaction,
+    queueing the transactional tasks it adds if the transaction
+    commits.
+    """
+    if QUEUE is not None:
+        return QUEUE.run_in_transaction(func, *args, **kwargs)
+    return db.run_in_transaction(func, *args, **kwargs)
+
+class LocalTaskQueue(object):
+    """
+    Runs tasks by calling a webapp2 app directly, before add() returns.
+
+    A task queued from inside another task runs after it finishes,
+    rather than inside it, so tasks run one at a time, in the order
+    they were queued.  Task names are remembered, like the App Engine
+    queue does, so a named task only ever runs once.  Transactional
+    tasks are held until their run_in_transaction commits, and dropped
+    if it doesn't.
+    """
+    def __init__(self, app):
+        self.app      = app
+        self.pending  = deque()
+        self.names    = set()
+        self.running  = False
+        self.lock     = threading.Lock()
+        # (url, params, status) of each task that has run
+        self.history  = []
+        # .held is the list of transactional tasks added by the
+        # transaction running on this thread, if there is one
+        self.local    = threading.local()
+
+    def add(self, url, params=None, name=None, transactional=False):
+        if transactional:
+            held = getattr(self.local, 'held', None)
+            if held is None:
+                raise RuntimeError("Transactional task added outside "
+                                   "tasks.run_in_transaction")
+            held.append((url, params))
+            return True
+        with self.lock:
+            if name is not None:
+                if name in self.names:
+                    return False
+                self.names.add(name)
+            self.pending.append((url, dict(params or {})))
+            if self.running:
+                return True
+            self.running = True
+        self.run()
+        return True
+
+    def run_in_transaction(self, func, *args, **kwargs):
+        def attempt():
+            # The transaction may be retried, and only the tasks of
+            # the attempt that commits count
+            self.local.held = []
+            return func(*args, **kwargs)
+        try:
+            result = db.run_in_transaction(attempt)
+            held = self.local.held
+        finally:
+            self.local.held = None
+        for (url, params) in held:
+            self.add(url, params)
+        return result
+
+    def run(self):
+        while True:
+            with self.lock:
+                if len(self.pending) == 0:
+                    self.running = False
+                    return
+                (url, params) = self.pending.popleft()
+            response = self.app.get_response(url, method='POST',
+                                             POST=params)
+            self.history.append((url, params, response.status_int))
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+"""
+The Jinja templates of the podcast app (home.html, course.xml, ...).
+
+Parsing and compiling a template takes much longer than rendering it,
+and a new App Engine instance would otherwise do that for each
+template the first time it's used.  So before deploying, run
+
+ templates.py
+
+which compiles every template into a python module in
+compiled_templates/.  In production, templates are loaded from there,
+and any template that isn't compiled is cached as bytecode in
+memcache.  A compiled template is only used if its file hasn't changed
+since it was compiled, so forgetting to run templates.py after editing
+a template just makes that template slower to load, not out of date.
+On the development server, templates are read from their files and
+reloaded when they change, as before.
+"""
+
+import hashlib
+import jinja2
+import json
+import logging
+import os
+
+try:
+    from google.appengine.api import memcache
+except ImportError:
+    memcache = None
+
+TEMPLATE_DIR = os.path.dirname(os.path.abspath(__file__))
+COMPILED_DIR = os.path.join(TEMPLATE_DIR, 'compiled_templates')
+EXTENSIONS = ('html', 'xml')
+# Written to the compiled directory by compile_all: the name of each
+# template compiled, and a hash of the file it was compiled from.
+MANIFEST = 'sources.json'
+
+def is_development():
+    """
+    Whether we're running on the development server.
+    """
+    return os.environ.get('SERVER_SOFTWARE', '').startswith('Development')
+
+def make_environment(development=None, compiled_dir=COMPILED_DIR,
+                     bytecode_cache=None, memcache_client=memcache):
+    """
+    Returns the jinja2.Environment for the app's templates.  Unless
+    another bytecode_cache is given, template bytecode is cached in
+    memcache_client, if there is one.
+    """
+    if development is None:
+        development = is_development()
+    if development:
+        return jinja2.Environment(
+            loader=jinja2.FileSystemLoader(TEMPLATE_DIR))
+
+    loader = jinja2.FileSystemLoader(TEMPLATE_DIR)
+    if compiled_dir is not None and os.path.isdir(compiled_dir):
+        loader = jinja2.ChoiceLoader([CompiledLoader(compiled_dir), loader])
+    if bytecode_cache is None and memcache_client is not None:
+        bytecode_cache = jinja2.MemcachedBytecodeCache(memcache_client)
+    return jinja2.Environment(loader=loader,
+                              auto_reload=False,
+                              bytecode_cache=bytecode_cache)
+
+class CompiledLoader(jinja2.ModuleLoader):
+    """
+    Loads the templates compiled by compile_all into path, except for
+    ones whose file has changed since.  Those aren't found here, so
+    they're read from their files instead.
+    """
+    def __init__(self, path):
+        jinja2.ModuleLoader.__init__(self, path)
+        self.current = current_templates(path)
+
+    def load(self, environment, name, globals=None):
+        if name not in self.current:
+            raise jinja2.TemplateNotFound(name)
+        return jinja2.ModuleLoader.load(self, environment, name, globals)
+
+def source_hash(name):
+    """
+    A hash of the named template's file, or None if there isn't one.
+    """
+    path = os.path.join(TEMPLATE_DIR, name)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as fd:
+        return hashlib.sha1(fd.read()).hexdigest()
+
+def current_templates(compiled_dir):
+    """
+    The names of the templates compiled into compiled_dir that are
+    still the same as their files.
+    """
+    path = os.path.join(compiled_dir, MANIFEST)
+    if not os.path.exists(path):
+        logging.warning("No %s, so not using compiled templates" % path)
+        return set()
+    with open(path) as fd:
+        compiled = json.load(fd)
+    current = set()
+    for (name, digest) in compiled.items():
+        if source_hash(name) == digest:
+            current.add(name)
+        else:
+            logging.warning("Compiled %s is out of date, run templates.py"
+                            % name)
+    return current
+
+def compile_all(target=COMPILED_DIR, verbose=True):
+    """
+    Compile all the templates into python modules in target, along with
+    the MANIFEST of what they were compiled from.
+    """
+    env = jinja2.Environment(loader=jinja2.FileSystemLoader(TEMPLATE_DIR))
+    env.compile_templates(target, extensions=EXTENSIONS, zip=None,
+                          log_function=log if verbose else None)
+    names = env.list_templates(extensions=EXTENSIONS)
+    with open(os.path.join(target, MANIFEST), 'w') as fd:
+        json.dump(dict((name, source_hash(name)) for name in names), fd,
+                  indent=1, sort_keys=True)
+
+def log(message):
+    print message
+
+if __name__ == "__main__":
+    compile_all()
@@ -0,0 +1 @@
+"The podcast app tests."
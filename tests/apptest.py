@@ -0,0 +1,97 @@
+"""
+A base class for tests of the podcast app, which run it against the
+App Engine testbed's datastore and memcache stubs, with the course
+list saved in course-list.20130318 rather than Coursera's.
+"""
+
+import imp
+import os
+import unittest
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import testbed
+
+import coursera_rss
+
+HERE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+COURSE_LIST = os.path.join(HERE, 'course-list.20130318')
+
+_app = None
+
+def import_app():
+    """
+    The app's module (gae-coursera-podcast.py), which can't be imported
+    by name.
+    """
+    global _app
+    if _app is None:
+        _app = imp.load_source('podcast',
+                               os.path.join(HERE, 'gae-coursera-podcast.py'))
+    return _app
+
+def make_lectures(count, prefix='L'):
+    """
+    count lectures, as coursera_rss.get_lecture_info returns them.
+    """
+    return [['%s%d' % (prefix, ii), '1:%02d' % ii, str(1000 + ii),
+             'http://videos/%s%d.mp4' % (prefix, ii),
+             'Week 1 : %s%d' % (prefix, ii), {}, '%s%d' % (prefix, ii)]
+            for ii in range(count)]
+
+class AppTestCase(unittest.TestCase):
+    """
+    Runs each test with an empty datastore and memcache.  self.app is
+    the app's module, and self.calls the datastore calls made (Get,
+    Put, Delete, ...) since clear_calls.
+    """
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.addCleanup(self.testbed.deactivate)
+        # Queries see every write straight away, like ancestor queries
+        policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+            probability=1)
+        self.testbed.init_datastore_v3_stub(consistency_policy=policy)
+        self.testbed.init_memcache_stub()
+        self.app = import_app()
+
+        catalogs = dict(coursera_rss.CATALOG_CACHES)
+        def restore_catalogs():
+            coursera_rss.CATALOG_CACHES.clear()
+            coursera_rss.CATALOG_CACHES.update(catalogs)
+        self.addCleanup(restore_catalogs)
+        coursera_rss.CATALOG_CACHES[None] = coursera_rss.CatalogCache(
+            COURSE_LIST, url=None)
+
+        self.calls = []
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+            'count_calls', self.count_call, 'datastore_v3')
+
+    def count_call(self, service, call, request, response):
+        self.calls.append(call)
+
+    def clear_calls(self):
+        del self.calls[:]
+
+    def patch(self, obj, name, value):
+        """
+        Set obj.name to value for the rest of the test.
+        """
+        old = getattr(obj, name)
+        setattr(obj, name, value)
+        self.addCleanup(setattr, obj, name, old)
+
+    def scrape_returns(self, lectures, failed=()):
+        """
+        Make the app's scrapes of a course's lectures give lectures,
+        with failed as the (position, lecture) pairs of those that
+        couldn't be read, rather than asking Coursera.
+        """
+        def get_preview_lectures(course_info, save_lectures=None,
+                                 concurrency=None, failed=None):
+            if failed is not None:
+                failed.extend(failed_lectures)
+            return [list(lecture) for lecture in lectures]
+        failed_lectures = list(failed)
+        self.patch(coursera_rss, 'get_preview_lectures', get_preview_lectures)
@@ -0,0 +1,140 @@
+"""
+Tests for saving a course's lectures (sync_lectures, place_lectures
+and update_lectures) against the datastore stub.
+"""
+
+from datetime import datetime
+
+from tests.apptest import AppTestCase, make_lectures
+
+UPDATED = datetime(2013, 3, 18, 12, 0, 0)
+
+class SyncLecturesTest(AppTestCase):
+    def setUp(self):
+        super(SyncLecturesTest, self).setUp()
+        self.course = self.app.Course(key_name='ml')
+        self.course.put()
+
+    def sync(self, lecture_data, delete=True):
+        self.clear_calls()
+        return self.app.sync_lectures(self.course, lecture_data, UPDATED,
+                                      delete=delete)
+
+    def saved(self):
+        """
+        The course's Lecture entities, by key name.
+        """
+        return dict((lecture.key().name(), lecture) for lecture in
+                    self.app.Lecture.all().ancestor(self.course))
+
+    def test_first_sync_writes_every_lecture_in_one_batch(self):
+        (published, written, unchanged, deleted) = self.sync(make_lectures(30))
+        self.assertEqual((written, unchanged, deleted), (30, 0, 0))
+        self.assertEqual(self.calls.count('Get'), 1)
+        self.assertEqual(self.calls.count('Put'), 1)
+        self.assertEqual(self.calls.count('Delete'), 0)
+        self.assertEqual(len(self.saved()), 30)
+        self.assertEqual(published, sorted(published))
+
+    def test_puts_and_deletes_are_split_into_batches(self):
+        self.patch(self.app, 'BATCH_SIZE', 10)
+        self.sync(make_lectures(25))
+        self.assertEqual(self.calls.count('Put'), 3)
+        (_, written, unchanged, deleted) = self.sync(make_lectures(3))
+        self.assertEqual((written, unchanged, deleted), (0, 3, 22))
+        self.assertEqual(self.calls.count('Delete'), 3)
+        self.assertEqual(len(self.saved()), 3)
+
+    def test_unchanged_resync_writes_nothing(self):
+        lectures = make_lectures(30)
+        first = self.sync(lectures)
+        again = self.sync(lectures)
+        self.assertEqual(again[1:], (0, 30, 0))
+        self.assertEqual(again[0], first[0])
+        self.assertEqual(self.calls.count('Put'), 0)
+        self.assertEqual(self.calls.count('Delete'), 0)
+
+    def test_lecture_added_at_top_writes_just_that_one(self):
+        lectures = make_lectures(30)
+        self.sync(lectures)
+        before = self.saved()
+        added = make_lectures(1, prefix='New')
+        (published, written, unchanged, deleted) = self.sync(added + lectures)
+        self.assertEqual((written, unchanged, deleted), (1, 30, 0))
+        self.assertEqual(self.calls.count('Put'), 1)
+        after = self.saved()
+        for (name, lecture) in before.items():
+            self.assertEqual(after[name].order, lecture.order)
+            self.assertEqual(after[name].published, lecture.published)
+        self.assertTrue(after['id:New0'].order < after['id:L0'].order)
+        self.assertEqual(published, sorted(published))
+
+    def test_removed_lecture_is_deleted(self):
+        lectures = make_lectures(30)
+        self.sync(lectures)
+        (_, written, unchanged, deleted) = self.sync(lectures[1:])
+        self.assertEqual((written, unchanged, deleted), (0, 29, 1))
+        self.assertNotIn('id:L0', self.saved())
+
+    def test_nothing_is_deleted_without_delete(self):
+        lectures = make_lectures(30)
+        self.sync(lectures)
+        (_, written, unchanged, deleted) = self.sync(lectures[5:],
+                                                     delete=False)
+        self.assertEqual((written, unchanged, deleted), (0, 25, 0))
+        self.assertEqual(len(self.saved()), 30)
+
+class UpdateLecturesTest(AppTestCase):
+    def feed_names(self, name):
+        course = self.app.Course.get_by_key_name(name)
+        return [lecture.name for lecture in self.app.course_lectures(course)]
+
+    def test_lectures_that_failed_to_scrape_are_kept(self):
+        lectures = make_lectures(20)
+        self.scrape_returns(lectures)
+        self.app.update_lectures('ml')
+
+        # Lectures 3 and 7 can't be read this time
+        failed = [(3, lectures[3][:2] + [None, None] + lectures[3][4:]),
+                  (6, lectures[7][:2] + [None, None] + lectures[7][4:])]
+        read = [lecture for (ii, lecture) in enumerate(lectures)
+                if ii not in (3, 7)]
+        self.scrape_returns(read, failed)
+        self.clear_calls()
+        self.assertEqual(self.app.update_lectures('ml'),
+                         ('done', "20 lectures, all unchanged, "
+                                  "2 couldn't be read"))
+        self.assertEqual(self.calls.count('Put'), 0)
+
+        # And when another lecture is added at the same time
+        added = make_lectures(1, prefix='New')
+        self.scrape_returns(added + read, [(position + 1, lecture)
+                                           for (position, lecture) in failed])
+        self.clear_calls()
+        (status, message) = self.app.update_lectures('ml')
+        self.assertEqual(status, 'done')
+        self.assertEqual(message, "21 lectures: 1 written, 20 unchanged, "
+                                  "0 deleted, 2 couldn't be read")
+        self.assertEqual(self.calls.count('Delete'), 0)
+        self.assertEqual(self.app.Lecture.all().count(), 21)
+        self.assertEqual(self.feed_names('ml'),
+                         [lecture[0] for lecture in added + lectures])
+        # Not the whole course, so the next update saves it again
+        self.assertIsNone(self.app.Course.get_by_key_name('ml').lectures_hash)
+
+        # Once they can all be read, a lecture that's gone is deleted
+        self.scrape_returns(added + lectures[1:])
+        (status, message) = self.app.update_lectures('ml')
+        self.assertEqual(message, '20 lectures: 0 written, 20 unchanged, '
+                                  '1 deleted')
+        self.assertEqual(self.feed_names('ml'),
+                         [lecture[0] for lecture in added + lectures[1:]])
+
+    def test_unchanged_update_writes_nothing(self):
+        self.scrape_returns(make_lectures(20))
+        self.app.update_lectures('ml')
+        self.clear_calls()
+        (status, message) = self.app.update_lectures('ml')
+        self.assertEqual((status, message), ('done',
+                                             '20 lectures, all unchanged'))
+        self.assertEqual(self.calls.count('Put'), 0)
@@ -0,0 +1,86 @@
+"""
+Tests for updating a course's lectures as a background job
+(request_update and run_update_job), with a tasks.LocalTaskQueue
+running the tasks.
+"""
+
+import json
+
+from google.appengine.ext import db
+
+import tasks
+from tests.apptest import AppTestCase, make_lectures
+
+class UpdateJobTest(AppTestCase):
+    def setUp(self):
+        super(UpdateJobTest, self).setUp()
+        self.queue = tasks.LocalTaskQueue(self.app.app)
+        self.patch(tasks, 'QUEUE', self.queue)
+        self.scrape_returns(make_lectures(10))
+
+    def job(self, name):
+        return db.get(self.app.job_key(name))
+
+    def test_update_runs_as_a_task(self):
+        (job, started) = self.app.request_update('ml')
+        self.assertTrue(started)
+        self.assertEqual(self.queue.history,
+                         [('/tasks/update', {'name': 'ml'}, 200)])
+        job = self.job('ml')
+        self.assertEqual(job.status, 'done')
+        self.assertEqual(job.message,
+                         '10 lectures: 10 written, 0 unchanged, 0 deleted')
+        self.assertEqual(self.app.Lecture.all().count(), 10)
+
+    def test_requests_while_a_job_runs_share_it(self):
+        # Ask again, by the course's other names, while the job is
+        # scraping the course
+        during = []
+        get_preview_lectures = self.app.scraper().get_preview_lectures
+        def scrape(course_info, **kwargs):
+            # Only the first time, in case they do start more jobs
+            if len(during) == 0:
+                for name in ('ml', 'ml-2012-002', 'ml-003'):
+                    during.append(self.app.request_update(name)[1])
+            return get_preview_lectures(course_info, **kwargs)
+        self.patch(self.app.scraper(), 'get_preview_lectures', scrape)
+
+        self.assertTrue(self.app.request_update('ml-003')[1])
+        self.assertEqual(during, [False, False, False])
+        self.assertEqual(len(self.queue.history), 1)
+        self.assertEqual(self.job('ml').key(), self.job('ml-2012-002').key())
+        self.assertEqual(self.job('ml-2012-002').status, 'done')
+
+    def test_finished_job_is_started_again(self):
+        self.app.request_update('ml')
+        (job, started) = self.app.request_update('ml-2012-002')
+        self.assertTrue(started)
+        self.assertEqual(len(self.queue.history), 2)
+        self.assertEqual(self.job('ml').message, '10 lectures, all unchanged')
+
+    def test_queued_job_is_shared(self):
+        # A job the caller runs itself has no task
+        (job, started) = self.app.request_update('ml', queue=False)
+        self.assertTrue(started)
+        (again, started) = self.app.request_update('ml-003')
+        self.assertFalse(started)
+        self.assertEqual(again.key(), job.key())
+        self.assertEqual(self.queue.history, [])
+        self.app.run_update_job('ml-003')
+        self.assertEqual(self.job('ml').status, 'done')
+
+    def test_status_page_finds_the_job_by_any_name(self):
+        self.app.app.get_response('/update?name=ml-2012-002')
+        response = self.app.app.get_response(
+            '/update_status?name=ml&format=json')
+        status = json.loads(response.body)
+        self.assertEqual((status['name'], status['status']), ('ml', 'done'))
+
+    def test_task_is_dropped_with_its_transaction(self):
+        def fail():
+            tasks.add('/tasks/update', {'name': 'ml'}, transactional=True)
+            raise ValueError("rolled back")
+        self.assertRaises(ValueError, tasks.run_in_transaction, fail)
+        self.assertEqual(self.queue.history, [])
+        self.assertRaises(RuntimeError, tasks.add, '/tasks/update',
+                          transactional=True)